@@ -0,0 +1,216 @@
+"""
+Columnar storage of flattened Nightscout frames.
+
+Rows are stored as Parquet or Arrow IPC files partitioned by site, data type
+and UTC day (root/site=.../type=.../day=YYYY-MM-DD/part.parquet). Loads are
+memory-mapped and read only the days and columns asked for. Requires the
+pyarrow package, imported when first used.
+"""
+import os
+import tempfile
+from urllib.parse import urlparse
+
+import pandas as pd
+
+import nscache
+import nscodec
+
+# Storage format -> file suffix.
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Partition of rows without a date, e.g. profiles.
+UNDATED = 'all'
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Columnar storage requires the pyarrow package')
+    return pyarrow
+
+
+def site_name(ns_url):
+    return urlparse(ns_url).netloc.replace(':', '_')
+
+
+def partition_root(root, ns_url, data_type):
+    return os.path.join(root, 'site=' + site_name(ns_url), 'type=' + data_type)
+
+
+def utc_timestamp(date):
+    return pd.Timestamp(nscache.to_ms(date), unit='ms', tz='UTC')
+
+
+def to_text(value):
+    """
+    Return value as text: JSON for nested values, None for missing ones.
+    """
+    if isinstance(value, (dict, list)):
+        return nscodec.dumps(value).decode('utf-8')
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return str(value)
+
+
+def to_table(df):
+    """
+    Convert df to an Arrow table; nested or mixed-type columns become text.
+    """
+    pa = require_pyarrow()
+    arrays = dict()
+    for col in df.columns:
+        try:
+            array = pa.Array.from_pandas(df[col])
+            if pa.types.is_nested(array.type):
+                raise pa.ArrowTypeError('nested')
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            array = pa.array(df[col].map(to_text).tolist(), type=pa.string())
+        arrays[str(col)] = array
+    return pa.table(arrays)
+
+
+def read_file(path, columns=None):
+    """
+    Read a partition file memory-mapped, with only columns it holds.
+    """
+    pa = require_pyarrow()
+    if path.endswith(FORMATS['parquet']):
+        if columns is not None:
+            names = pa.parquet.read_schema(path, memory_map=True).names
+            columns = [col for col in columns if col in names]
+        return pa.parquet.read_table(path, columns=columns, memory_map=True)
+    # Uncompressed IPC files are read without copying.
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    if columns is not None:
+        table = table.select([col for col in columns
+                              if col in table.column_names])
+    return table
+
+
+def write_file(table, path):
+    pa = require_pyarrow()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    if path.endswith(FORMATS['parquet']):
+        pa.parquet.write_table(table, tmp_path)
+    else:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def concat_tables(tables):
+    """
+    Concatenate tables with differing columns; columns whose types can't be
+    promoted are read as text.
+    """
+    pa = require_pyarrow()
+    types = dict()
+    for table in tables:
+        for field in table.schema:
+            if not pa.types.is_null(field.type):
+                types.setdefault(field.name, set()).add(field.type)
+    conflicting = {name for name, col_types in types.items()
+                   if len(col_types) > 1 and not all(
+                       pa.types.is_integer(t) or pa.types.is_floating(t)
+                       for t in col_types)}
+    for i, table in enumerate(tables):
+        for name in conflicting & set(table.column_names):
+            index = table.column_names.index(name)
+            tables[i] = table = table.set_column(
+                index, name, table.column(name).cast(pa.string()))
+    try:
+        return pa.concat_tables(tables, promote_options='permissive')
+    except TypeError:  # pyarrow < 14
+        return pa.concat_tables(tables, promote=True)
+
+
+def write_partitions(df, root, ns_url, data_type, storage_format='parquet'):
+    """
+    Store df, one file per UTC day, merged with rows already stored by _id.
+
+    Return the paths of the files written.
+    """
+    time_col = nscache.TIME_FIELDS.get(data_type)
+    if time_col in df.columns:
+        days = pd.to_datetime(df[time_col], utc=True).dt.strftime('%Y-%m-%d')
+        days = days.fillna(UNDATED)
+    else:
+        days = pd.Series(UNDATED, index=df.index)
+    paths = []
+    for day, part in df.groupby(days.values, sort=True):
+        path = os.path.join(partition_root(root, ns_url, data_type),
+                            'day=' + day, 'part' + FORMATS[storage_format])
+        table = to_table(part)
+        if os.path.exists(path):
+            # New rows replace stored ones with the same _id.
+            table = concat_tables([table, read_file(path)])
+            if '_id' in table.column_names:
+                stored = table.to_pandas()
+                table = to_table(stored.drop_duplicates('_id', keep='first'))
+        if time_col in table.column_names:
+            table = table.sort_by(time_col)
+        write_file(table, path)
+        paths.append(path)
+    return paths
+
+
+def partition_files(root, ns_url, data_type, after_date=None,
+                    before_date=None):
+    """
+    Return the stored files of days overlapping the dates, oldest first.
+    """
+    base = partition_root(root, ns_url, data_type)
+    first = last = None
+    if after_date is not None:
+        first = utc_timestamp(after_date).strftime('%Y-%m-%d')
+    if before_date is not None:
+        last = utc_timestamp(before_date).strftime('%Y-%m-%d')
+    try:
+        names = sorted(os.listdir(base))
+    except OSError:
+        return []
+    files = []
+    for name in names:
+        day = name[len('day='):]
+        if day != UNDATED and ((first and day < first)
+                               or (last and day > last)):
+            continue
+        for suffix in FORMATS.values():
+            path = os.path.join(base, name, 'part' + suffix)
+            if os.path.exists(path):
+                files.append(path)
+    return files
+
+
+def load_partitions(root, ns_url, data_type, after_date=None,
+                    before_date=None, columns=None):
+    """
+    Return stored rows dated in (after_date, before_date], newest first.
+
+    Only the days in range and the given columns (all if None) are read.
+    """
+    time_col = nscache.TIME_FIELDS.get(data_type)
+    read_columns = columns
+    if columns is not None and time_col and time_col not in columns:
+        read_columns = list(columns) + [time_col]
+    tables = [read_file(path, read_columns) for path in partition_files(
+        root, ns_url, data_type, after_date, before_date)]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = concat_tables(tables).to_pandas()
+    if time_col in df.columns:
+        times = pd.to_datetime(df[time_col], utc=True)
+        keep = pd.Series(True, index=df.index)
+        if after_date is not None:
+            keep &= times > utc_timestamp(after_date)
+        if before_date is not None:
+            keep &= times <= utc_timestamp(before_date)
+        df = df[keep.values].iloc[::-1].reset_index(drop=True)
+        if columns is not None and time_col not in columns:
+            df = df.drop(columns=[time_col])
+    return df
@@ -0,0 +1,703 @@
+"""
+Offline benchmark of the Nightscout fetch, parse and render stages.
+
+Starts a local stand-in for the Nightscout API (v1 and v3) serving
+synthetic AndroidAPS data, then times ns_data, get_ns_data and build_graph
+against it. Results are printed (or written) as JSON, e.g.:
+
+    python nsbench.py --days 30 --interval 5 --workers 4 --output bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import nscache
+import nscodec
+
+# Field each data type is sorted and filtered on, as in Nightscout.
+SORT_FIELDS = {
+    'entries': 'date',
+    'devicestatus': 'created_at',
+    'treatments': 'created_at',
+}
+
+
+def iso_z(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(
+        moment.microsecond // 1000)
+
+
+def synth_devicestatus(end, days, interval_min=5, seed=0):
+    """
+    Generate AndroidAPS devicestatus documents, one every interval_min.
+    """
+    rng = random.Random(seed)
+    steps = int(days * 24 * 60 / interval_min)
+    bg = 120.0
+    docs = []
+    for i in range(steps):
+        moment = end - datetime.timedelta(minutes=interval_min * i)
+        stamp = iso_z(moment)
+        bg = min(350, max(45, bg + rng.gauss(0, 4)))
+        isf = rng.choice([35, 40, 45, 50])
+        cr = rng.choice([7, 8, 9, 10])
+        iob = round(rng.uniform(-0.5, 4), 2)
+        reason = ('COB: {cob}, Dev: {dev}, BGI: {bgi}, ISF: {isf}, CR: {cr}, '
+                  'Target: 100, minPredBG {pred}, minGuardBG {guard}, '
+                  'IOBpredBG {pred}, tdd: {tdd}, DiaSMB: 5, smbRatio: 0.5, '
+                  'limitIOB: 8, ; Eventual BG {pred} >= 100, '
+                  'insulinReq 0. temp 0.8 >~ req 0.75U/hr. ').format(
+                      cob=rng.randint(0, 60), dev=rng.randint(-20, 20),
+                      bgi=round(rng.uniform(-5, 1), 1), isf=isf, cr=cr,
+                      pred=int(bg), guard=int(bg) - 20,
+                      tdd=round(rng.uniform(25, 45), 2))
+        docs.append({
+            '_id': '{:024x}'.format(rng.getrandbits(96)),
+            'device': 'openaps://AndroidAPS-{}'.format(seed),
+            'created_at': stamp,
+            'uploaderBattery': rng.randint(20, 100),
+            'isCharging': rng.random() < 0.3,
+            'pump': {
+                'clock': stamp,
+                'battery': {'percent': rng.randint(10, 100)},
+                'reservoir': round(rng.uniform(20, 300), 1),
+                'status': {'status': 'normal', 'timestamp': stamp},
+                'extended': {'Version': '3.1.0', 'ActiveProfile': 'Default',
+                             'BaseBasalRate': 0.8},
+            },
+            'openaps': {
+                'suggested': {
+                    'bg': int(bg),
+                    'temp': 'absolute',
+                    'timestamp': stamp,
+                    'reason': reason,
+                    'eventualBG': int(bg),
+                    'targetBG': 100,
+                    'COB': rng.randint(0, 60),
+                    'IOB': iob,
+                    'deliverAt': stamp,
+                    'predBGs': {
+                        'IOB': [int(bg) + j for j in range(48)],
+                        'ZT': [int(bg) - j for j in range(48)],
+                    },
+                },
+                'enacted': {
+                    'bg': int(bg),
+                    'rate': round(rng.uniform(0, 3), 2),
+                    'duration': 30,
+                    'received': True,
+                    'timestamp': stamp,
+                },
+                'iob': {
+                    'iob': iob,
+                    'basaliob': round(iob / 2, 2),
+                    'activity': round(rng.uniform(0, 0.05), 4),
+                    'time': stamp,
+                },
+            },
+        })
+    return docs
+
+
+def synth_entries(end, days, interval_min=5, seed=0):
+    """
+    Generate CGM sgv entries, one every interval_min.
+    """
+    rng = random.Random(seed + 1)
+    steps = int(days * 24 * 60 / interval_min)
+    sgv = 120
+    docs = []
+    for i in range(steps):
+        moment = end - datetime.timedelta(minutes=interval_min * i)
+        sgv = int(min(400, max(40, sgv + rng.gauss(0, 4))))
+        docs.append({
+            '_id': '{:024x}'.format(rng.getrandbits(96)),
+            'type': 'sgv',
+            'sgv': sgv,
+            'direction': rng.choice(['Flat', 'FortyFiveUp', 'FortyFiveDown']),
+            'device': 'AndroidAPS-DexcomG6',
+            'date': int(moment.timestamp() * 1000),
+            'dateString': iso_z(moment),
+        })
+    return docs
+
+
+def synth_treatments(end, days, seed=0):
+    """
+    Generate boluses, carbs and temp basals, a few dozen per day.
+    """
+    rng = random.Random(seed + 2)
+    docs = []
+    moment = end
+    while moment > end - datetime.timedelta(days=days):
+        moment -= datetime.timedelta(minutes=rng.randint(10, 90))
+        kind = rng.choice(['Correction Bolus', 'Meal Bolus', 'Temp Basal'])
+        doc = {
+            '_id': '{:024x}'.format(rng.getrandbits(96)),
+            'eventType': kind,
+            'created_at': iso_z(moment),
+            'enteredBy': 'openaps://AndroidAPS',
+        }
+        if kind == 'Temp Basal':
+            doc.update({'rate': round(rng.uniform(0, 3), 2), 'duration': 30})
+        else:
+            doc['insulin'] = round(rng.uniform(0.1, 6), 2)
+            if kind == 'Meal Bolus':
+                doc['carbs'] = rng.randint(10, 80)
+        docs.append(doc)
+    return docs
+
+
+def synth_profile():
+    return [{
+        '_id': '{:024x}'.format(1),
+        'defaultProfile': 'Default',
+        'startDate': '2020-01-01T00:00:00.000Z',
+        'store': {'Default': {
+            'dia': 5, 'timezone': 'UTC', 'units': 'mg/dl',
+            'carbratio': [{'time': '00:00', 'value': 8}],
+            'sens': [{'time': '00:00', 'value': 40}],
+            'basal': [{'time': '00:00', 'value': 0.8}],
+            'target_low': [{'time': '00:00', 'value': 100}],
+            'target_high': [{'time': '00:00', 'value': 110}],
+        }},
+    }]
+
+
+def project(doc, fields):
+    """
+    Return the API v3 fields projection of doc; dotted fields reach into it.
+    """
+    if not fields or fields == '_all':
+        return doc
+    projected = {}
+    for field in fields.split(','):
+        parts = field.split('.')
+        value = doc
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = projected
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+    return projected
+
+
+def v3_params(params):
+    """
+    Translate API v3 field$op filters to find[field][$op] ones.
+    """
+    find = {'count': params.get('limit', 10)}
+    for name, value in params.items():
+        field, op = name.partition('$')[::2]
+        if op and field != 'sort':
+            find['find[{}][${}]'.format(field, op)] = value
+    return find
+
+
+def query_value_ms(value, data_type):
+    """
+    Return a find[...] query value as epoch ms, whatever its format.
+    """
+    if data_type == 'entries':
+        return float(value)
+    return nscache.doc_time_ms({SORT_FIELDS[data_type]: value}, data_type)
+
+
+class StubData:
+    """
+    Documents per data type, indexed by date, with request counters.
+    """
+
+    def __init__(self, collections):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.collections = {}
+        # data type -> _id -> (srvModified, document, isValid), for API v3
+        self.changes = {}
+        self.clock = 0
+        for data_type, docs in collections.items():
+            if data_type in SORT_FIELDS:
+                keyed = sorted(((nscache.doc_time_ms(doc, data_type), doc)
+                                for doc in docs), key=lambda item: item[0])
+                self.collections[data_type] = ([key for key, _ in keyed],
+                                               [doc for _, doc in keyed])
+                self.changes[data_type] = {doc['_id']: (key, doc, True)
+                                           for key, doc in keyed}
+            else:
+                self.collections[data_type] = docs
+
+    def change(self, data_type, doc, valid=True):
+        """
+        Add or replace a document, or delete it unless valid, as of now.
+        """
+        with self.lock:
+            keys, docs = self.collections[data_type]
+            for i, held in enumerate(docs):
+                if held['_id'] == doc['_id']:
+                    del keys[i], docs[i]
+                    break
+            if valid:
+                key = nscache.doc_time_ms(doc, data_type)
+                i = bisect_right(keys, key)
+                keys.insert(i, key)
+                docs.insert(i, doc)
+            self.clock = max(self.clock + 1, int(time.time() * 1000))
+            self.changes[data_type][doc['_id']] = (self.clock, doc, valid)
+
+    def v3_document(self, data_type, doc, fields):
+        modified, _, valid = self.changes[data_type][doc['_id']]
+        doc = dict(doc, identifier=doc['_id'], srvModified=modified,
+                   isValid=valid)
+        del doc['_id']
+        return project(doc, fields)
+
+    def history(self, data_type, last_modified, params):
+        """
+        Return documents changed after last_modified, oldest change first.
+        """
+        changed = sorted((item for item in self.changes[data_type].values()
+                          if item[0] > last_modified), key=lambda item: item[0])
+        fields = params.get('fields')
+        return [self.v3_document(data_type, doc, fields)
+                for _, doc, _ in changed[:int(params.get('limit', 10))]]
+
+    def find(self, data_type, params):
+        """
+        Return documents matching find[field][op] params, newest first.
+        """
+        if data_type not in SORT_FIELDS:
+            return self.collections.get(data_type, [])
+        keys, docs = self.collections[data_type]
+        lo, hi = 0, len(keys)
+        for name, value in params.items():
+            if not name.startswith('find['):
+                continue
+            op = name.rsplit('[', 1)[1].rstrip(']')
+            value_ms = query_value_ms(value, data_type)
+            if op == '$gt':
+                lo = max(lo, bisect_right(keys, value_ms))
+            elif op == '$gte':
+                lo = max(lo, bisect_left(keys, value_ms))
+            elif op == '$lt':
+                hi = min(hi, bisect_left(keys, value_ms))
+            elif op == '$lte':
+                hi = min(hi, bisect_right(keys, value_ms))
+        count = int(params.get('count', 10))
+        return docs[max(lo, hi - count):hi][::-1] if hi > lo else []
+
+    def count(self, body_bytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += body_bytes
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.connections = 0
+
+
+def make_handler(stub):
+    class NightscoutStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            stub.connected()
+
+        def do_HEAD(self):
+            self.do_GET(head=True)
+
+        def do_GET(self, head=False):
+            parsed = urlparse(self.path)
+            params = dict(parse_qsl(parsed.query))
+            parts = parsed.path.strip('/').split('/')
+            if parsed.path in ('', '/'):
+                body = b'Nightscout stub'
+            elif len(parts) == 3 and parts[:2] == ['api', 'v1'] \
+                    and parts[2].endswith('.json'):
+                data_type = parts[2][:-len('.json')]
+                body = json.dumps(stub.find(data_type, params)).encode('utf-8')
+            elif len(parts) == 3 and parts[:2] == ['api', 'v3']:
+                data_type = parts[2]
+                result = [stub.v3_document(data_type, doc, params.get('fields'))
+                          for doc in stub.find(data_type, v3_params(params))]
+                body = json.dumps({'status': 200, 'result': result}).encode('utf-8')
+            elif len(parts) == 5 and parts[:2] == ['api', 'v3'] \
+                    and parts[3] == 'history':
+                result = stub.history(parts[2], int(parts[4]), params)
+                body = json.dumps({'status': 200, 'result': result}).encode('utf-8')
+            else:
+                self.send_error(404)
+                return
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                stub.count(0)
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+            if gzipped:
+                body = gzip.compress(body, compresslevel=6, mtime=0)
+            stub.count(0 if head else len(body))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('ETag', etag)
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return NightscoutStubHandler
+
+
+@contextlib.contextmanager
+def stub_server(collections):
+    """
+    Serve collections on a local port; yield (base url, StubData).
+    """
+    stub = StubData(collections)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(stub))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_port), stub
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def reset_peak_rss():
+    """
+    Reset the process's peak RSS, so the next reading covers one stage.
+
+    Return whether it could be reset (Linux only); otherwise peak RSS is
+    that of the whole process so far.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def proc_status_bytes(field):
+    """
+    Return a memory field of /proc/self/status (e.g. VmRSS) in bytes, or
+    None where there is none.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes():
+    peak = proc_status_bytes('VmHWM')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def measure(stage, stub, trace_alloc, func, *args, **kwargs):
+    """
+    Run func, returning its result and the stage's metrics.
+
+    tracemalloc slows Python code down several times, so peak allocations
+    are only traced (and wall times inflated) when trace_alloc is set. Peak
+    RSS is the stage's where it can be reset, else the process's so far;
+    peak_rss_scope tells which. With a stage scope, peak_rss_growth_bytes is
+    how far the stage raised RSS above what it started with.
+    """
+    stub.reset_counters()
+    rss_reset = reset_peak_rss()
+    rss_start = proc_status_bytes('VmRSS')
+    if trace_alloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    # Fetch progress goes to stderr so stdout stays valid JSON.
+    with contextlib.redirect_stdout(sys.stderr):
+        result = func(*args, **kwargs)
+    wall = time.perf_counter() - start
+    metrics = {
+        'stage': stage,
+        'wall_s': round(wall, 4),
+        'requests': stub.requests,
+        'connections': stub.connections,
+        'bytes': stub.bytes_sent,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'peak_rss_scope': 'stage' if rss_reset else 'process',
+    }
+    if rss_reset and rss_start is not None:
+        metrics['peak_rss_growth_bytes'] = metrics['peak_rss_bytes'] - rss_start
+    if trace_alloc:
+        metrics['peak_alloc_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, metrics
+
+
+def import_seconds(statement, setup='pass'):
+    """
+    Return the seconds a fresh interpreter takes to run an import statement,
+    after setup.
+    """
+    code = ('{}; import time; start = time.perf_counter(); {}; '
+            'print(time.perf_counter() - start)').format(setup, statement)
+    result = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.split()[-1])
+
+
+def run_imports():
+    """
+    Time cold imports: of the viewer, then of each module it only imports
+    when used.
+    """
+    stages = [{'stage': 'import.nsview',
+               'wall_s': round(import_seconds('import nsview'), 4)}]
+    for module in ('nsdata', 'plotly.graph_objects', 'st_aggrid',
+                   'extra_streamlit_components'):
+        seconds = import_seconds('import ' + module, setup='import nsview')
+        stages.append({'stage': 'import.lazy.' + module,
+                       'wall_s': round(seconds, 4)})
+    return stages
+
+
+def run_columnar(ns_url, min_date, max_date, stub, trace_alloc, workers=1,
+                 processes=1):
+    """
+    Time building the devicestatus frame nsexport stores, storing it in each
+    columnar format, then loading it all, a few columns, and the viewer's
+    columns through nsview.get_ns_data. Skipped without pyarrow.
+    """
+    import nsarrow
+    import nsexport
+    import nsview
+
+    try:
+        nsarrow.require_pyarrow()
+    except ImportError:
+        return []
+    df, metrics = measure('columnar.frame', stub, trace_alloc,
+                          nsexport.columnar_frame, ns_url, '', 'devicestatus',
+                          max_date, min_date, workers=workers,
+                          processes=processes)
+    metrics['rows'] = len(df)
+    metrics['columns'] = len(df.columns)
+    stages = [metrics]
+    columns = ['created_at', 'suggested.bg', 'reason.ISF', 'reason.CR',
+               'reason.tdd']
+    with tempfile.TemporaryDirectory() as root:
+        for storage_format in nsarrow.FORMATS:
+            directory = os.path.join(root, storage_format)
+            paths, metrics = measure(
+                'columnar.write.' + storage_format, stub, trace_alloc,
+                nsarrow.write_partitions, df, directory, ns_url,
+                'devicestatus', storage_format)
+            metrics['file_bytes'] = sum(os.path.getsize(p) for p in paths)
+            stages.append(metrics)
+            for stage, load_columns in (('load', None), ('load_projected', columns)):
+                loaded, metrics = measure(
+                    'columnar.{}.{}'.format(stage, storage_format), stub,
+                    trace_alloc, nsarrow.load_partitions, directory, ns_url,
+                    'devicestatus', columns=load_columns)
+                metrics['rows'] = len(loaded)
+                metrics['frame_bytes'] = int(loaded.memory_usage(deep=True).sum())
+                stages.append(metrics)
+            nsview.PARTITIONS_DIR = directory
+            try:
+                loaded, metrics = measure(
+                    'get_ns_data.partitions.' + storage_format, stub,
+                    trace_alloc, nsview.get_ns_data, ns_url, '', min_date,
+                    max_date, nsview.TZ_DONT_CONVERT)
+            finally:
+                nsview.PARTITIONS_DIR = ''
+            metrics['rows'] = len(loaded)
+            stages.append(metrics)
+    return stages
+
+
+def run_sync(ns_url, stub, end, min_date, max_date, interval_min, seed,
+             trace_alloc):
+    """
+    Time cached devicestatus through API v1 and v3: a first fetch, a repeat,
+    and a repeat once an hour of new loop runs has arrived.
+    """
+    import nsdata
+
+    stages = []
+    df, metrics = measure('ns_data.devicestatus.v3', stub, trace_alloc,
+                          nsdata.ns_data, 'devicestatus', ns_url, '',
+                          max_date, min_date, api='v3')
+    metrics['rows'] = len(df)
+    stages.append(metrics)
+    new_docs = synth_devicestatus(end + datetime.timedelta(hours=1), 1 / 24,
+                                  interval_min, seed + 1)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for stage in ('cache_cold', 'cache_warm', 'sync'):
+            if stage == 'sync':
+                for doc in new_docs:
+                    stub.change('devicestatus', doc)
+            for api in nsdata.API_VERSIONS:
+                df, metrics = measure(
+                    '{}.{}'.format(stage, api), stub, trace_alloc,
+                    nsdata.ns_data, 'devicestatus', ns_url, '', max_date,
+                    min_date, cache_dir=cache_dir, api=api)
+                metrics['rows'] = len(df)
+                stages.append(metrics)
+    return stages
+
+
+def run(days, interval_min, workers, seed=0, trace_alloc=False, processes=1):
+    """
+    Run every benchmark stage against synthetic data; return the results.
+    """
+    import nsdata
+    import nsrollup
+    import nsview
+
+    end = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    collections = {
+        'devicestatus': synth_devicestatus(end, days, interval_min, seed),
+        'entries': synth_entries(end, days, interval_min, seed),
+        'treatments': synth_treatments(end, days, seed),
+        'profile': synth_profile(),
+    }
+    max_date = str(end + datetime.timedelta(days=1))
+    min_date = str(end - datetime.timedelta(days=days))
+
+    stages = run_imports()
+    with stub_server(collections) as (ns_url, stub):
+        for data_type in ('entries', 'treatments', 'profile', 'devicestatus'):
+            df, metrics = measure('ns_data.' + data_type, stub, trace_alloc,
+                                  nsdata.ns_data,
+                                  data_type, ns_url, '', max_date, min_date,
+                                  workers=workers)
+            metrics['rows'] = len(df)
+            stages.append(metrics)
+        stages.extend(run_columnar(ns_url, min_date, max_date, stub,
+                                   trace_alloc, workers, processes))
+
+        nsview.CACHE_DIR = ''
+        nsview.FETCH_WORKERS = workers
+        nsview.FLATTEN_PROCESSES = processes
+        df, metrics = measure('get_ns_data', stub, trace_alloc,
+                              nsview.get_ns_data, ns_url, '', min_date, max_date, nsview.TZ_DONT_CONVERT)
+        metrics['rows'] = len(df)
+        metrics['columns'] = len(df.columns)
+        metrics['frame_bytes'] = int(df.memory_usage(deep=True).sum())
+        stages.append(metrics)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            nsview.CACHE_DIR = cache_dir
+            for stage in ('get_ns_data.cache_cold', 'get_ns_data.cache_warm'):
+                _, metrics = measure(stage, stub, trace_alloc,
+                                     nsview.get_ns_data, ns_url, '', min_date,
+                                     max_date, nsview.TZ_DONT_CONVERT)
+                stages.append(metrics)
+
+            # Rollups of the whole range, then read back as the viewer would
+            start_ms, end_ms = nscache.to_ms(min_date), nscache.to_ms(max_date)
+            _, metrics = measure('rollup.update', stub, trace_alloc,
+                                 nsrollup.update_rollups, cache_dir, ns_url,
+                                 df, start_ms, end_ms)
+            stages.append(metrics)
+            # Buckets still open to late uploads are never stored: end before
+            read_end_ms = nscache.to_ms(end) - nscache.UPLOAD_MARGIN_MS
+            for resolution in nsrollup.RESOLUTIONS:
+                rollup, metrics = measure('rollup.read.' + resolution, stub,
+                                          trace_alloc, nsrollup.read_rollup,
+                                          cache_dir, ns_url, resolution,
+                                          start_ms, read_end_ms)
+                metrics['rows'] = len(rollup)
+                stages.append(metrics)
+
+        stages.extend(run_sync(ns_url, stub, end, min_date, max_date,
+                               interval_min, seed, trace_alloc))
+
+        fig, metrics = measure('build_graph', stub, trace_alloc,
+                               nsview.build_graph, df, 'suggested.bg', 'reason.ISF', 'reason.CR')
+        metrics['figure_json_bytes'] = len(fig.to_json())
+        stages.append(metrics)
+
+    return {
+        'params': {'days': days, 'interval_min': interval_min,
+                   'workers': workers, 'processes': processes,
+                   'seed': seed,
+                   'trace_alloc': trace_alloc,
+                   'json_backend': nscodec.BACKEND,
+                   'devicestatus_docs': len(collections['devicestatus'])},
+        'python': platform.python_version(),
+        'stages': stages,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--days', type=float, default=7,
+                        help='history length of synthetic data')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='minutes between devicestatus/entries documents')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='concurrent fetch workers')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes flattening devicestatus payloads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-alloc', action='store_true',
+                        help='also record peak Python allocations per stage')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    results = run(args.days, args.interval, args.workers, args.seed,
+                  args.trace_alloc, args.processes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
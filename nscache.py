@@ -0,0 +1,311 @@
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+import arrow
+
+# Document field each range-queried data type is filtered on.
+TIME_FIELDS = {
+    'entries': 'date',
+    'devicestatus': 'created_at',
+    'treatments': 'created_at',
+}
+
+
+# Without a history of changes (API v1), ranges are only held up to this long
+# before now, so documents uploaded late (phone offline, queued uploads) are
+# still fetched on the next request.
+UPLOAD_MARGIN_MS = 60 * 60 * 1000
+
+# Stores and rollups unused for this long are removed, checked at most every
+# PRUNE_INTERVAL_S seconds.
+MAX_AGE_S = 30 * 24 * 60 * 60
+PRUNE_INTERVAL_S = 60 * 60
+
+# Store path -> lock held while a store is read, completed and saved.
+_store_locks = dict()
+_store_locks_lock = threading.Lock()
+
+# Cache directory -> time of its last prune.
+_pruned = dict()
+
+
+def site_key(ns_url, token=''):
+    """
+    Return a short, filesystem-safe key identifying a Nightscout site and the
+    token it is read with, so cached data is only served to holders of that
+    token.
+    """
+    normalized = ns_url.strip().lower().rstrip('/')
+    return hashlib.sha1('{}\n{}'.format(normalized, token).encode(
+        'utf-8')).hexdigest()[:16]
+
+
+def to_ms(value):
+    """
+    Convert a date string, datetime or arrow object to UTC epoch milliseconds.
+    """
+    return int(arrow.get(value).timestamp() * 1000)
+
+
+def ms_to_iso(value):
+    """
+    Convert UTC epoch milliseconds to an ISO 8601 string.
+    """
+    return arrow.get(value / 1000).isoformat()
+
+
+def doc_time_ms(doc, data_type):
+    """
+    Return the UTC epoch milliseconds of a document, or None if it has none.
+    """
+    value = doc.get(TIME_FIELDS[data_type])
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        try:
+            return to_ms(value)
+        except (TypeError, ValueError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def merge_intervals(intervals):
+    """
+    Merge overlapping or adjacent (start, end] millisecond intervals.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_intervals(held, start, end):
+    """
+    Return the sub-intervals of (start, end] not covered by held intervals.
+    """
+    missing = []
+    cursor = start
+    for held_start, held_end in merge_intervals(held):
+        if held_end <= cursor:
+            continue
+        if held_start >= end:
+            break
+        if held_start > cursor:
+            missing.append([cursor, held_start])
+        cursor = max(cursor, held_end)
+        if cursor >= end:
+            break
+    if cursor < end:
+        missing.append([cursor, end])
+    return missing
+
+
+def store_dir(cache_dir, ns_url, data_type, api='v1', token=''):
+    # API v3 documents are projected and identified differently: kept apart.
+    name = data_type if api == 'v1' else '{}.{}'.format(data_type, api)
+    return os.path.join(cache_dir, site_key(ns_url, token), name)
+
+
+def _path_lock(path):
+    with _store_locks_lock:
+        return _store_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def store_lock(cache_dir, ns_url, data_type, api='v1', token=''):
+    """
+    Return the process-wide lock of a site and data type's store.
+    """
+    return _path_lock(store_dir(cache_dir, ns_url, data_type, api, token))
+
+
+def load_store(cache_dir, ns_url, data_type, api='v1', token=''):
+    """
+    Load held intervals and documents for a site and data type.
+
+    Documents are returned as a dict of _id -> (epoch ms, document).
+    """
+    path = store_dir(cache_dir, ns_url, data_type, api, token)
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            intervals = json.load(f)['intervals']
+        with open(os.path.join(path, 'docs.pkl'), 'rb') as f:
+            docs = pickle.load(f)
+        touch(os.path.join(path, 'meta.json'))
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+        return [], dict()
+    return intervals, docs
+
+
+def touch(path):
+    """
+    Mark a cache file as used now, keeping it from being pruned.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _listdir(path):
+    try:
+        return [os.path.join(path, name) for name in os.listdir(path)]
+    except OSError:
+        return []
+
+
+def prune(cache_dir, max_age_s=MAX_AGE_S):
+    """
+    Remove stores and rollups not used for max_age_s seconds.
+
+    Done at most every PRUNE_INTERVAL_S per cache directory; return whether
+    it was done.
+    """
+    now = time.time()
+    with _store_locks_lock:
+        if now - _pruned.get(cache_dir, 0) < PRUNE_INTERVAL_S:
+            return False
+        _pruned[cache_dir] = now
+    for site_path in _listdir(cache_dir):
+        for path in _listdir(site_path):
+            meta_path = os.path.join(path, 'meta.json')
+            if os.path.exists(meta_path):
+                with _path_lock(path):
+                    try:
+                        if now - os.path.getmtime(meta_path) > max_age_s:
+                            shutil.rmtree(path, ignore_errors=True)
+                    except OSError:
+                        pass
+                continue
+            # Rollups, one file per resolution.
+            for file_path in _listdir(path):
+                try:
+                    if now - os.path.getmtime(file_path) > max_age_s:
+                        os.remove(file_path)
+                except OSError:
+                    pass
+        # Emptied directories go too; rmdir leaves any others.
+        for path in _listdir(site_path) + [site_path]:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+    return True
+
+
+def _atomic_write(path, data, mode):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def pseudonym_key(cache_dir):
+    """
+    Return the secret key of the pseudonyms in a cache directory's data,
+    drawn once and kept there so pseudonyms stay stable across restarts.
+    """
+    path = os.path.join(cache_dir, 'pseudonym.key')
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(32))
+    # Linking fails if another process drew its key first: use that one.
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def save_store(cache_dir, ns_url, data_type, intervals, docs, api='v1',
+               token=''):
+    """
+    Atomically persist held intervals and documents for a site and data type.
+    """
+    path = store_dir(cache_dir, ns_url, data_type, api, token)
+    os.makedirs(path, exist_ok=True)
+    # Documents first: intervals must never claim data that isn't on disk.
+    _atomic_write(os.path.join(path, 'docs.pkl'),
+                  pickle.dumps(docs, protocol=pickle.HIGHEST_PROTOCOL), 'wb')
+    _atomic_write(os.path.join(path, 'meta.json'),
+                  json.dumps({'intervals': intervals}), 'w')
+
+
+def load_sync(cache_dir, ns_url, data_type, api, token=''):
+    """
+    Load the sync state of a store: fields held and history position.
+    """
+    path = os.path.join(store_dir(cache_dir, ns_url, data_type, api, token),
+                        'sync.json')
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_sync(cache_dir, ns_url, data_type, api, sync, token=''):
+    """
+    Persist the sync state of a store, after the store itself.
+    """
+    path = store_dir(cache_dir, ns_url, data_type, api, token)
+    os.makedirs(path, exist_ok=True)
+    _atomic_write(os.path.join(path, 'sync.json'), json.dumps(sync), 'w')
+
+
+def add_documents(docs, new_docs, data_type):
+    """
+    Merge fetched documents into docs, replacing any with the same _id.
+
+    Documents marked deleted (isValid false, from API v3 history) are removed.
+    Return the number of documents added, changed or removed.
+    """
+    changed = 0
+    for doc in new_docs:
+        if doc.get('isValid') is False:
+            changed += docs.pop(doc.get('_id'), None) is not None
+            continue
+        doc_time = doc_time_ms(doc, data_type)
+        if doc_time is None:
+            continue
+        doc_id = doc.get('_id') or '{}:{}'.format(doc_time, hashlib.md5(
+            json.dumps(doc, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest())
+        if docs.get(doc_id) != (doc_time, doc):
+            docs[doc_id] = (doc_time, doc)
+            changed += 1
+    return changed
+
+
+def select_documents(docs, start, end):
+    """
+    Return documents in (start, end], newest first as Nightscout returns them.
+    """
+    selected = [(doc_time, doc) for doc_time, doc in docs.values()
+                if start < doc_time <= end]
+    selected.sort(key=lambda item: item[0], reverse=True)
+    return [doc for _, doc in selected]
@@ -0,0 +1,72 @@
+"""
+JSON codec of Nightscout documents, using orjson or msgspec when installed.
+
+Bodies are decoded once, straight from bytes, and batches of documents are
+encoded by one call. All backends write the same compact UTF-8 JSON. Call
+through the module (nscodec.loads), as use_backend rebinds the functions.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _json_codec():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return encoder.encode(obj).encode('utf-8')
+
+    def dumps_lines(items):
+        return ''.join([encoder.encode(item) + '\n'
+                        for item in items]).encode('utf-8')
+
+    return json.loads, dumps, dumps_lines
+
+
+def _orjson_codec():
+    def dumps_lines(items):
+        return b''.join([orjson.dumps(item) + b'\n' for item in items])
+
+    return orjson.loads, orjson.dumps, dumps_lines
+
+
+def _msgspec_codec():
+    encoder = msgspec.json.Encoder()
+    return msgspec.json.decode, encoder.encode, encoder.encode_lines
+
+
+# Backend name -> factory of (loads, dumps, dumps_lines), fastest first.
+BACKENDS = {
+    'orjson': _orjson_codec if orjson is not None else None,
+    'msgspec': _msgspec_codec if msgspec is not None else None,
+    'json': _json_codec,
+}
+
+
+def available_backends():
+    return [name for name, codec in BACKENDS.items() if codec is not None]
+
+
+def use_backend(name=None):
+    """
+    Switch to backend name, or to the fastest one installed.
+    """
+    global BACKEND, loads, dumps, dumps_lines
+    name = name or available_backends()[0]
+    if BACKENDS.get(name) is None:
+        raise ValueError('JSON backend {} is not available'.format(name))
+    BACKEND = name
+    loads, dumps, dumps_lines = BACKENDS[name]()
+
+
+# loads(bytes or str) -> object, dumps(object) -> bytes and
+# dumps_lines(items) -> bytes, one document per line.
+use_backend()
@@ -1,19 +1,107 @@
-import datetime
+import gzip
 import hashlib
+import hmac
 import json
 import logging
+import multiprocessing
 import os
 import random
 import string
-from io import StringIO
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Full, Queue
 from urllib.parse import urlparse
 
 import arrow
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+import nscache
+import nscodec
+from nsperf import NULL_RECORDER
 
 MAX_RETRIES = 4
 
+# Retry delays grow exponentially from BACKOFF_BASE up to BACKOFF_MAX seconds,
+# with full jitter.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# (connect, read) timeout of each request, in seconds.
+REQUEST_TIMEOUT = (10, 120)
+
+# Non-200 statuses worth retrying; others fail at once.
+RETRY_STATUSES = [408, 429, 500, 502, 503, 504]
+
+# Maximum items requested per query, and per API v3 query (its server limit).
+PAGE_SIZE = 5000
+V3_PAGE_SIZE = 1000
+
+# Pages fetched ahead per segment of a concurrent query, so memory stays
+# bounded however long the range.
+SEGMENT_PAGES_AHEAD = 2
+
+# Nightscout APIs: v1 returns whole documents, v3 only the fields asked for
+# and the documents changed since a sync.
+API_VERSIONS = ['v1', 'v3']
+
+# Fields requested per data type through API v3: those nsview uses, leaving
+# out devicestatus predBGs and the like.
+V3_FIELDS = {
+    'devicestatus': [
+        'created_at', 'device', 'uploaderBattery', 'isCharging', 'uploader',
+        'pump', 'openaps.iob', 'openaps.suggested.bg',
+        'openaps.suggested.tick', 'openaps.suggested.eventualBG',
+        'openaps.suggested.targetBG', 'openaps.suggested.insulinReq',
+        'openaps.suggested.carbsReq', 'openaps.suggested.sensitivityRatio',
+        'openaps.suggested.COB', 'openaps.suggested.IOB',
+        'openaps.suggested.rate', 'openaps.suggested.duration',
+        'openaps.suggested.units', 'openaps.suggested.temp',
+        'openaps.suggested.reason', 'openaps.suggested.deliverAt',
+        'openaps.suggested.timestamp', 'openaps.enacted.bg',
+        'openaps.enacted.rate', 'openaps.enacted.duration',
+        'openaps.enacted.units', 'openaps.enacted.received',
+        'openaps.enacted.timestamp'],
+    'entries': ['date', 'dateString', 'type', 'sgv', 'direction', 'device'],
+    'treatments': ['created_at', 'eventType', 'insulin', 'carbs', 'rate',
+                   'duration', 'enteredBy'],
+}
+
+# Fields API v3 identifies and syncs documents by.
+V3_SYNC_FIELDS = ['identifier', 'srvModified', 'isValid']
+
+# History is requested from this long before the last sync, so that writes
+# landing late or a skewed server clock don't slip past it.
+HISTORY_MARGIN_MS = 5 * 60 * 1000
+
+# Keep-alive connections kept open per host, and hosts kept in the pool.
+POOL_SIZE = 16
+POOL_HOSTS = 8
+
+# Requests per second allowed to each host, on average and in a burst.
+HOST_RATE = 5
+HOST_BURST = 10
+
+# (processes, executor) flattening records, shared by all callers once started.
+_flatten_pool = (0, None)
+_flatten_pool_lock = threading.Lock()
+
+# Secret key of the pseudonyms replacing potentially sensitive values. Set
+# NSVIEW_PSEUDONYM_KEY to keep pseudonyms stable across restarts; otherwise
+# each process draws its own key, and cache and export directories keep one
+# (see resolve_pseudonym_key).
+PSEUDONYM_KEY = (os.environ.get('NSVIEW_PSEUDONYM_KEY', '').encode('utf-8')
+                 or os.urandom(32))
+PSEUDONYM_ALPHABET = string.ascii_uppercase + string.digits
+PSEUDONYM_LENGTH = 6
+
+# Every encoding urllib3 can decode here: gzip, deflate and br when brotli is
+# installed.
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+
 # Set up logging.
 logger = logging.getLogger(__name__)
 
@@ -28,299 +116,836 @@ def normalize_url(url_input):
     Return URL with scheme + netloc only, e.g. 'https://www.example.com'.
 
     If no scheme is specified, try https, fall back to http.
-    Return None if a GET to the normalized URL doesn't return a 200 status.
+    Return None if the normalized URL doesn't return a 200 status.
     """
     if not url_input.startswith('http'):
         url_input = 'https://' + url_input
     parsed = urlparse(url_input)
     url = parsed.scheme + '://' + parsed.netloc
     try:
-        test_url = requests.get(url)
+        status_code = TRANSPORT.status(url)
     except requests.exceptions.SSLError:
         url = 'http://' + parsed.netloc
-        test_url = requests.get(url)
-    if test_url.status_code != 200:
+        status_code = TRANSPORT.status(url)
+    if status_code != 200:
         return None
     return url
 
 
-def sub_sensitive(targ_dict, subs_dict, keyval):
+def pseudonym(value, key=None):
     """
-    Sub potentially sensitive keyval in targ_dict w/random string in subs_dict
+    Return the pseudonym of value: 6 characters derived from its HMAC.
+
+    The same value and key always give the same pseudonym.
     """
-    try:
-        targ_dict[keyval] = subs_dict[targ_dict[keyval]]
-    except KeyError:
+    digest = hmac.new(key or PSEUDONYM_KEY, str(value).encode('utf-8'),
+                      hashlib.sha256).digest()
+    number = int.from_bytes(digest, 'big')
+    chars = []
+    for _ in range(PSEUDONYM_LENGTH):
+        number, index = divmod(number, len(PSEUDONYM_ALPHABET))
+        chars.append(PSEUDONYM_ALPHABET[index])
+    return ''.join(chars)
+
+
+def resolve_pseudonym_key(key_dir=None):
+    """
+    Return the key of the pseudonyms of data kept in key_dir, e.g. a cache or
+    export directory: NSVIEW_PSEUDONYM_KEY if set, else one drawn once and
+    kept there. Without key_dir, PSEUDONYM_KEY.
+    """
+    if os.environ.get('NSVIEW_PSEUDONYM_KEY') or not key_dir:
+        return PSEUDONYM_KEY
+    return nscache.pseudonym_key(key_dir)
+
+
+def pseudonymize(items, keyval, key=None):
+    """
+    Replace keyval of items by its pseudonym, computed once per distinct value.
+    """
+    values = {item[keyval] for item in items
+              if item.get(keyval) is not None}
+    subs = {value: pseudonym(value, key) for value in values}
+    for item in items:
+        if item.get(keyval) is not None:
+            item[keyval] = subs[item[keyval]]
+    return items
+
+
+class TokenBucket:
+    """
+    Rate limit of rate acquisitions per second, allowing bursts of burst.
+
+    Also counts the acquisitions, the seconds waited and the threads waiting.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.wait_s = 0.0
+        self.waiting = 0
+        self.max_waiting = 0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available; return seconds waited.
+        """
+        start = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
         try:
-            subs_dict[targ_dict[keyval]] = ''.join(random.choice(
-                string.ascii_uppercase + string.digits) for _ in range(6))
-            targ_dict[keyval] = subs_dict[targ_dict[keyval]]
-        except KeyError:
-            pass
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens
+                                      + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    delay = (1 - self.tokens) / self.rate
+                time.sleep(delay)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        waited = time.monotonic() - start
+        with self.lock:
+            self.acquired += 1
+            self.wait_s += waited
+        return waited
 
 
-def get_ns_entries(ns_url, token, file_obj, before_date, after_date):
+class Transport:
     """
-    Get Nightscout entries data, ~60 days at a time.
+    Shared HTTP transport: pooled keep-alive connections, compressed responses
+    and conditional GETs, scheduled for the whole process.
 
-    Retrieve ~60 days at a time until either (a) the start point is reached
-    (after_date parameter) or (b) a run of 6 empty calls or (c) Jan 2010.
+    Thread-safe; one instance serves all fetchers, so connections are reused
+    across windows, data types, sites and sessions. Identical requests in
+    flight are sent once and their response shared, and each host is rate
+    limited by a token bucket. Overlapping but different ranges are only
+    fetched once through the document cache (ns_data with a cache_dir).
     """
-    end = arrow.get(before_date).ceil('second').timestamp() * 1000
-    start = arrow.get('2010-01-01').floor('second').timestamp() * 1000
-    if after_date:
-        start = arrow.get(after_date).floor('second').timestamp() * 1000
 
-    ns_entries_url = ns_url + '/api/v1/entries.json'
+    def __init__(self, timeout=REQUEST_TIMEOUT, pool_size=POOL_SIZE,
+                 pool_hosts=POOL_HOSTS, host_rate=HOST_RATE,
+                 host_burst=HOST_BURST):
+        self.timeout = timeout
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self._lock = threading.Lock()
+        # (url, params) -> last 200 response with validators
+        self._validated = dict()
+        # (url, params, conditional) -> Future of the request in flight
+        self._in_flight = dict()
+        # host -> TokenBucket
+        self._buckets = dict()
+        # host -> requests served by another's response
+        self._coalesced = dict()
 
-    # Start a JSON array.
-    file_obj.write('[')
-    initial_entry_done = False  # Entries after initial are preceded by commas.
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.host_rate,
+                                                  self.host_burst)
+                self._coalesced[host] = 0
+            return self._buckets[host]
 
-    # Get 8 million second chunks (~ 1/4th year) until none, or start reached.
-    complete = False
-    curr_end = end
-    curr_start = curr_end - 5000000000
-    empty_run = 0
-    retries = 0
-    while not complete:
-        if curr_start < start:
-            curr_start = start
-            complete = True
-            logger.debug('Final round (starting date reached)...')
-        log_update('Querying entries from {} to {}...'.format(
-            arrow.get(curr_start / 1000).format(),
-            arrow.get(curr_end / 1000).format()))
-        ns_params = {'count': 1000000}
-        ns_params['find[date][$lte]'] = curr_end
-        ns_params['find[date][$gt]'] = curr_start
-        ns_params['token'] = token
-        entries_req = requests.get(ns_entries_url, params=ns_params)
-        logger.debug('Request complete.')
-        assert entries_req.status_code == 200 or retries < MAX_RETRIES, \
-            'NS entries URL != 200 status'
-        if entries_req.status_code != 200:
+    def get(self, url, params=None, conditional=False, event=None):
+        """
+        GET url; return (response, not_modified).
+
+        With conditional, the last response carrying an ETag or Last-Modified
+        is revalidated; when the server answers 304 it is returned again
+        with not_modified set. If the same request is already in flight, its
+        result is awaited instead. The seconds waited for the host's rate
+        limit and whether the request was coalesced are added to event.
+        """
+        event = event if event is not None else dict()
+        key = (url, tuple(sorted((params or {}).items())), conditional)
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = Future()
+        if not leader:
+            with self._lock:
+                self._coalesced[urlparse(url).netloc] += 1
+            event['coalesced'] = event.get('coalesced', 0) + 1
+            return flight.result()
+        try:
+            event['wait_s'] = event.get('wait_s', 0) + self.bucket(url).acquire()
+            result = self._get(url, params, conditional)
+            flight.set_result(result)
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _get(self, url, params, conditional):
+        key = (url, tuple(sorted((params or {}).items())))
+        headers = dict()
+        cached = None
+        if conditional:
+            with self._lock:
+                cached = self._validated.get(key)
+            if cached is not None:
+                if 'ETag' in cached.headers:
+                    headers['If-None-Match'] = cached.headers['ETag']
+                if 'Last-Modified' in cached.headers:
+                    headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        response = self.session.get(url, params=params, headers=headers,
+                                    timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            return cached, True
+        if conditional and response.status_code == 200 and (
+                'ETag' in response.headers
+                or 'Last-Modified' in response.headers):
+            response.content  # Read the body before sharing the response.
+            with self._lock:
+                self._validated[key] = response
+        return response, False
+
+    def status(self, url):
+        """
+        Return the status code of url, without downloading its body.
+        """
+        self.bucket(url).acquire()
+        response = self.session.head(url, allow_redirects=True,
+                                     timeout=self.timeout)
+        if response.status_code in (405, 501):
+            # HEAD not allowed: GET, but only read the headers.
+            with self.session.get(url, stream=True,
+                                  timeout=self.timeout) as response:
+                pass
+        return response.status_code
+
+    def stats(self):
+        """
+        Return scheduler counters per host: requests sent, requests coalesced,
+        requests waiting now and at most, and seconds waited.
+        """
+        with self._lock:
+            buckets = dict(self._buckets)
+            coalesced = dict(self._coalesced)
+        stats = dict()
+        for host, bucket in buckets.items():
+            with bucket.lock:
+                stats[host] = {
+                    'requests': bucket.acquired,
+                    'coalesced': coalesced[host],
+                    'waiting': bucket.waiting,
+                    'max_waiting': bucket.max_waiting,
+                    'wait_s': round(bucket.wait_s, 3),
+                }
+        return stats
+
+
+TRANSPORT = Transport()
+
+
+def wire_bytes(response):
+    """
+    Return the bytes received for the body of response, before decoding.
+    """
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return len(response.content)
+
+
+def backoff_delay(retries):
+    """
+    Return seconds to wait before a retry: exponential, with full jitter.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retries))
+
+
+def get_ns_page(data_type, url, params, conditional=False,
+                perf=NULL_RECORDER):
+    """
+    Query one page, retrying failures up to MAX_RETRIES times with backoff.
+
+    Timeouts, connection errors and RETRY_STATUSES are retried. With
+    conditional, an unchanged page is revalidated instead of downloaded
+    again. Return the decoded list of items.
+    """
+    with perf.stage('fetch.' + data_type) as event:
+        retries = 0
+        while True:
+            event['retries'] = retries
+            try:
+                data_req, not_modified = TRANSPORT.get(
+                    url, params=params, conditional=conditional, event=event)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if retries >= MAX_RETRIES:
+                    raise
+                retries += 1
+                logger.debug("RETRY {}: {}".format(retries, e))
+                time.sleep(backoff_delay(retries))
+                continue
+            logger.debug('Request complete.')
+            assert data_req.status_code == 200 or (
+                retries < MAX_RETRIES
+                and data_req.status_code in RETRY_STATUSES), \
+                'NS {} URL != 200 status'.format(data_type)
+            if data_req.status_code == 200:
+                break
             retries += 1
             logger.debug("RETRY {}: Status code is {}".format(
-                retries, entries_req.status_code))
-            continue
+                retries, data_req.status_code))
+            time.sleep(backoff_delay(retries))
         logger.debug('Status code 200.')
-        retries = 0
-        logger.debug('Retrieved {} entries...'.format(len(entries_req.json())))
-        if entries_req.json():
-            empty_run = 0
-            for entry in entries_req.json():
-                if initial_entry_done:
-                    file_obj.write(',')  # JSON array separator
-                else:
-                    initial_entry_done = True
-                json.dump(entry, file_obj)
-            logger.debug('Wrote {} entries to file...'.format(len(entries_req.json())))
-        else:
-            empty_run += 1
-            if empty_run > 6:
-                logger.debug('>10 empty calls: ceasing entries queries.')
-                break
+        items = nscodec.loads(data_req.content)
+        if isinstance(items, dict) and 'result' in items:
+            # API v3 wraps items as {status, result}.
+            items = items['result']
+        event['bytes'] = len(data_req.content)
+        event['wire_bytes'] = 0 if not_modified else wire_bytes(data_req)
+        event['not_modified'] = not_modified
+        event['records'] = len(items)
+        logger.debug('Retrieved {} {} items...'.format(len(items), data_type))
+    return items
+
+
+def query_windows(start, end, step):
+    """
+    Return (start, end) query windows of length step, newest first.
+
+    The final window is clipped to the start point.
+    """
+    windows = []
+    curr_end = end
+    while True:
+        curr_start = curr_end - step
+        if curr_start < start:
+            windows.append((start, curr_end))
+            return windows
+        windows.append((curr_start, curr_end))
         curr_end = curr_start
-        curr_start = curr_end - 5000000000
 
-    file_obj.write(']')  # End of JSON array.
-    logger.debug('Done writing entries to file.')
+
+def v3_fields(data_type, fields=None):
+    """
+    Return the API v3 fields projection of a data type, sync fields included.
+    """
+    fields = V3_FIELDS.get(data_type, []) if fields is None else fields
+    return ','.join(V3_SYNC_FIELDS + [field for field in fields
+                                      if field not in V3_SYNC_FIELDS])
 
 
-def get_ns_devicestatus(ns_url, token, file_obj, before_date, after_date):
+def v3_document(doc):
+    """
+    Key an API v3 document by its identifier, as _id for the cache and joins.
     """
-    Get Nightscout devicestatus data, 2 days at a time.
+    if '_id' not in doc and 'identifier' in doc:
+        doc['_id'] = doc['identifier']
+    return doc
 
-    Retrieve four days at a time until either (a) the start point is reached
-    (after_date parameter) or (b) a run of 40 empty calls or (c) Oct 2014.
+
+def page_params(api, date_field, cursor_op, cursor, lower, page_size,
+                fields):
     """
-    end = arrow.get(before_date).ceil('second')
-    start = arrow.get('2014-10-01').floor('second')
-    if after_date:
-        start = arrow.get(after_date).floor('second')
+    Return the query of a page of items dated after lower, up to cursor.
+    """
+    if api == 'v3':
+        ns_params = {'limit': page_size, 'sort$desc': date_field,
+                     'fields': fields}
+        ns_params['{}{}'.format(date_field, cursor_op)] = cursor
+        ns_params['{}$gt'.format(date_field)] = lower
+        return ns_params
+    ns_params = {'count': page_size}
+    ns_params['find[{}][{}]'.format(date_field, cursor_op)] = cursor
+    ns_params['find[{}][$gt]'.format(date_field)] = lower
+    return ns_params
+
+
+def page_ns_items(data_type, url, token, date_field, lower, upper,
+                  page_size=PAGE_SIZE, api='v1', fields=None,
+                  perf=NULL_RECORDER):
+    """
+    Generate pages of items dated in (lower, upper], newest first.
+
+    Each query asks for at most page_size items at or before a cursor, which
+    then moves to the date of the last item seen. Items sharing that date are
+    skipped on the next page by _id. Paging stops at the first short page.
+    With api 'v3', only the fields projection (a comma separated string) of
+    each item is requested.
+    """
+    cursor = upper
+    cursor_op = '$lte'
+    boundary_ids = set()
+    while True:
+        log_update('Querying {} from {} to {}...'.format(
+            data_type, lower, cursor))
+        ns_params = page_params(api, date_field, cursor_op, cursor, lower,
+                                page_size, fields)
+        ns_params['token'] = token
+        page = get_ns_page(data_type, url, ns_params, perf=perf)
+        if api == 'v3':
+            page = [v3_document(item) for item in page]
+        items = [item for item in page if item.get('_id') not in boundary_ids]
+        if items:
+            yield items
+        if len(page) < page_size:
+            return
+        last = page[-1].get(date_field)
+        if last is None:
+            logger.warning('{} item without {}: ceasing queries.'.format(
+                data_type, date_field))
+            return
+        if last == cursor:
+            # A full page shares one date: step past it rather than loop.
+            logger.warning('>{} {} items dated {}: skipping the rest.'.format(
+                page_size, data_type, last))
+            cursor_op = '$lt'
+            boundary_ids = set()
+        else:
+            cursor_op = '$lte'
+            boundary_ids = {item.get('_id') for item in page
+                            if item.get(date_field) == last}
+        cursor = last
+
+
+def iter_ns_pages(data_type, ns_url, token, start, end, date_field,
+                  format_date, sensitive_key=None, workers=1,
+                  pseudonym_key=None, api='v1', fields=None,
+                  perf=NULL_RECORDER):
+    """
+    Generate pages of items dated in (start, end], newest first.
+
+    With workers > 1 the range is split into that many segments, paged
+    concurrently up to SEGMENT_PAGES_AHEAD pages ahead; pages are still
+    generated in order. Values of
+    sensitive_key are replaced by pseudonyms keyed on pseudonym_key
+    (default PSEUDONYM_KEY), in whichever thread fetched the page.
+    """
+    if api == 'v3':
+        url = ns_url + '/api/v3/{}'.format(data_type)
+        page_size = V3_PAGE_SIZE
+        fields = v3_fields(data_type, fields)
+    else:
+        url = ns_url + '/api/v1/{}.json'.format(data_type)
+        page_size = PAGE_SIZE
+
+    def pages(segment):
+        for items in page_ns_items(data_type, url, token, date_field,
+                                   format_date(segment[0]),
+                                   format_date(segment[1]),
+                                   page_size=page_size, api=api,
+                                   fields=fields, perf=perf):
+            if sensitive_key:
+                with perf.stage('pseudonymize', records=len(items)):
+                    pseudonymize(items, sensitive_key, pseudonym_key)
+            yield items
 
-    # Dict for consistent subs of recurring potentially sensitive strings.
-    subs = dict()
+    stopped = threading.Event()
 
-    ns_entries_url = ns_url + '/api/v1/devicestatus.json'
+    def put(page_queue, page):
+        # Give up once the consumer is gone, rather than block on a full queue.
+        while not stopped.is_set():
+            try:
+                page_queue.put(page, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
 
+    def queue_pages(segment, page_queue):
+        if stopped.is_set():
+            return
+        try:
+            for page in pages(segment):
+                if not put(page_queue, page):
+                    return
+        finally:
+            put(page_queue, None)
+
+    def ordered_pages():
+        if workers > 1 and end > start:
+            segments = query_windows(start, end, (end - start) / workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                queued = []
+                for segment in segments:
+                    page_queue = Queue(maxsize=SEGMENT_PAGES_AHEAD)
+                    queued.append((executor.submit(queue_pages, segment,
+                                                   page_queue), page_queue))
+                # Drain segments in order; later ones wait, a few pages
+                # ahead, until reached. Segments are started in order too,
+                # so the one drained is always running.
+                try:
+                    for future, page_queue in queued:
+                        yield from iter(page_queue.get, None)
+                        future.result()
+                finally:
+                    stopped.set()
+        else:
+            yield from pages((start, end))
+
+    yield from ordered_pages()
+
+
+def write_json_array(file_obj, pages, data_type):
+    """
+    Write pages of items to file_obj as a single JSON array.
+    """
     # Start a JSON array.
     file_obj.write('[')
-    initial_entry_done = False  # Entries after initial are preceded by commas.
+    initial_entry_done = False  # Pages after initial are preceded by commas.
+    for items in pages:
+        if items:
+            if initial_entry_done:
+                file_obj.write(',')  # JSON array separator
+            else:
+                initial_entry_done = True
+            # One encode per page; its brackets are dropped to extend the array.
+            file_obj.write(nscodec.dumps(items)[1:-1].decode('utf-8'))
+        logger.debug('Wrote {} {} items to file...'.format(
+            len(items), data_type))
+    file_obj.write(']')  # End of JSON array.
+    logger.debug('Done writing {} items to file.'.format(data_type))
 
-    # Get 8 million second chunks (~ 1/4th year) until none, or start reached.
-    complete = False
-    curr_end = end
-    curr_start = curr_end - datetime.timedelta(days=2)
-    empty_run = 0
-    retries = 0
-    while not complete:
-        if curr_start < start:
-            curr_start = start
-            complete = True
-            logger.debug('Final round (starting date reached)...')
-        log_update('Querying devicestatus from {} to {}...'.format(
-            curr_start.isoformat(), curr_end.isoformat()))
-        ns_params = {'count': 1000000}
-        ns_params['find[created_at][$lte]'] = curr_end.isoformat()
-        ns_params['find[created_at][$gt]'] = curr_start.isoformat()
-        ns_params['token'] = token
-        devicestatus_req = requests.get(ns_entries_url, params=ns_params)
-        logger.debug('Request complete.')
-        assert devicestatus_req.status_code == 200 or retries < MAX_RETRIES, \
-            'NS devicestatus URL != 200 status'
-        if devicestatus_req.status_code != 200:
-            retries += 1
-            logger.debug("RETRY {}: Status code is {}".format(
-                retries, devicestatus_req.status_code))
-            continue
-        logger.debug('Status code 200.')
-        retries = 0
-        logger.debug('Retrieved {} devicestatus items...'.format(
-            len(devicestatus_req.json())))
-        if devicestatus_req.json():
-            empty_run = 0
-            for item in devicestatus_req.json():
-                sub_sensitive(item, subs, 'device')
-                if initial_entry_done:
-                    file_obj.write(',')  # JSON array separator
-                else:
-                    initial_entry_done = True
-                json.dump(item, file_obj)
-            logger.debug('Wrote {} devicestatus items to file...'.format(
-                len(devicestatus_req.json())))
-        else:
-            # Quit if more than 10 empty weeks have been encountered.
-            empty_run += 1
-            if empty_run > 40:
-                logger.debug('>10 empty weeks: ceasing devicestatus queries.')
-                break
-        curr_end = curr_start
-        curr_start = curr_end - datetime.timedelta(days=2)
 
-    file_obj.write(']')
-    logger.debug('Done writing devicestatus items to file.')
+# Per ranged data type: date field, earliest date queried, date formatter for
+# queries and potentially sensitive key.
+RANGED_TYPES = {
+    'entries': ('date', '2010-01-01', lambda d: int(d.timestamp() * 1000),
+                None),
+    'devicestatus': ('created_at', '2014-10-01', lambda d: d.isoformat(),
+                     'device'),
+    'treatments': ('created_at', '2012-01-01', lambda d: d.isoformat(),
+                   'enteredBy'),
+}
 
 
-def get_ns_treatments(ns_url, token, file_obj, before_date, after_date):
+def iter_ns_data(data_type, ns_url, token, before_date, after_date,
+                 workers=1, pseudonym_key=None, api='v1', fields=None,
+                 perf=NULL_RECORDER):
     """
-    Get Nightscout treatments data, 20 days at a time.
+    Generate pages of decoded Nightscout items, before and after dates.
 
-    Retrieve in chunks and write to file until (a) the start point is reached
-    (after_date parameter) or (b) a run of 15 empty calls or (c) Jan 2012.
+    Profile is a single query; other data types are paged backwards until
+    the start point is reached (after_date, or the earliest date for the
+    data type) or no older items remain. Potentially sensitive values are
+    pseudonymized with pseudonym_key (default PSEUDONYM_KEY).
+
+    With api 'v3', items hold only fields (default V3_FIELDS of the data
+    type). Profiles, small and revalidated, always come from API v1.
     """
+    assert api in API_VERSIONS, 'Unknown Nightscout API {}'.format(api)
+    assert data_type in ['treatments', 'profile', 'entries', 'devicestatus']
+
+    # A single query works for sparse data.
+    if data_type == 'profile':
+        ns_data_url = ns_url + '/api/v1/profile.json'
+        ns_params = {'count': 1000000}
+        ns_params['token'] = token
+        items = get_ns_page(data_type, ns_data_url, ns_params,
+                            conditional=True, perf=perf)
+        if items:
+            yield items
+        return
+
+    date_field, earliest, format_date, sensitive_key = RANGED_TYPES[data_type]
     end = arrow.get(before_date).ceil('second')
-    start = arrow.get('2012-01-01').floor('second')
+    start = arrow.get(earliest).floor('second')
     if after_date:
         start = arrow.get(after_date).floor('second')
 
-    # Dict for consistent subs of recurring potentially sensitive strings.
-    subs = dict()
+    yield from iter_ns_pages(data_type, ns_url, token, start, end, date_field,
+                             format_date, sensitive_key=sensitive_key,
+                             workers=workers, pseudonym_key=pseudonym_key,
+                             api=api, fields=fields, perf=perf)
 
-    ns_entries_url = ns_url + '/api/v1/treatments.json'
 
-    # Start a JSON array.
-    file_obj.write('[')
-    initial_entry_done = False  # Entries after initial are preceded by commas.
+def iter_ns_history(data_type, ns_url, token, last_modified, fields=None,
+                    pseudonym_key=None, page_size=V3_PAGE_SIZE,
+                    perf=NULL_RECORDER):
+    """
+    Generate pages of items changed after last_modified (epoch ms), oldest
+    change first, from the API v3 history of a data type.
 
-    # Get 8 million second chunks (~ 1/4th year) until none, or start reached.
-    complete = False
-    curr_end = end
-    curr_start = curr_end - datetime.timedelta(days=20)
-    empty_run = 0
-    retries = 0
-    while not complete:
-        if curr_start < start:
-            curr_start = start
-            complete = True
-            logger.debug('Final round (starting date reached)...')
-        log_update('Querying treatments from {} to {}...'.format(
-            curr_start.isoformat(), curr_end.isoformat()))
-        ns_params = {'count': 1000000}
-        ns_params['find[created_at][$lte]'] = curr_end.isoformat()
-        ns_params['find[created_at][$gt]'] = curr_start.isoformat()
-        ns_params['token'] = token
-        treatments_req = requests.get(ns_entries_url, params=ns_params)
-        logger.debug('Request complete.')
-        assert treatments_req.status_code == 200 or retries < MAX_RETRIES, \
-            'NS treatments URL != 200 status'
-        if treatments_req.status_code != 200:
-            retries += 1
-            logger.debug("RETRY {}: Status code is {}".format(
-                retries, treatments_req.status_code))
-            continue
-        logger.debug('Status code 200.')
-        retries = 0
-        logger.debug('Retrieved {} treatments items...'.format(
-            len(treatments_req.json())))
-        if treatments_req.json():
-            empty_run = 0
-            for item in treatments_req.json():
-                sub_sensitive(item, subs, 'enteredBy')
-                if initial_entry_done:
-                    file_obj.write(',')  # JSON array separator
-                else:
-                    initial_entry_done = True
-                json.dump(item, file_obj)
-            logger.debug('Wrote {} treatments items to file...'.format(
-                len(treatments_req.json())))
+    Deleted items come with isValid false. Items hold only fields, as in
+    iter_ns_data.
+    """
+    url = ns_url + '/api/v3/{}/history/'.format(data_type)
+    sensitive_key = RANGED_TYPES[data_type][3]
+    ns_params = {'limit': page_size, 'fields': v3_fields(data_type, fields),
+                 'token': token}
+    while True:
+        log_update('Querying {} changed since {}...'.format(
+            data_type, nscache.ms_to_iso(last_modified)))
+        page = [v3_document(item) for item in get_ns_page(
+            data_type, url + str(last_modified), ns_params, perf=perf)]
+        if sensitive_key:
+            pseudonymize(page, sensitive_key, pseudonym_key)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last = page[-1].get('srvModified')
+        if last is None:
+            logger.warning('{} item without srvModified: ceasing queries.'.format(
+                data_type))
+            return
+        if last - 1 <= last_modified:
+            # A full page shares one change time: step past it rather than loop.
+            logger.warning('>{} {} items changed at {}: skipping the rest.'.format(
+                page_size, data_type, last))
+            last_modified = last
         else:
-            # Quit if more than 10 empty weeks have been encountered.
-            empty_run += 1
-            if empty_run > 15:
-                logger.debug('>15 empty calls: ceasing treatments queries.')
-                break
-        curr_end = curr_start
-        curr_start = curr_end - datetime.timedelta(days=20)
+            # Changes sharing the last time may continue on the next page.
+            last_modified = last - 1
 
-    file_obj.write(']')
-    logger.debug('Done writing treatments items to file.')
+
+def get_ns_entries(ns_url, token, file_obj, before_date, after_date,
+                   workers=1):
+    """
+    Get Nightscout entries data, PAGE_SIZE entries at a time.
+
+    Page backwards until either (a) the start point is reached (after_date
+    parameter) or (b) no older entries remain or (c) Jan 2010.
+    """
+    write_json_array(file_obj, iter_ns_data(
+        'entries', ns_url, token, before_date, after_date, workers=workers),
+        'entries')
+
+
+def get_ns_devicestatus(ns_url, token, file_obj, before_date, after_date,
+                        workers=1):
+    """
+    Get Nightscout devicestatus data, PAGE_SIZE items at a time.
+
+    Page backwards until either (a) the start point is reached (after_date
+    parameter) or (b) no older items remain or (c) Oct 2014.
+    """
+    write_json_array(file_obj, iter_ns_data(
+        'devicestatus', ns_url, token, before_date, after_date,
+        workers=workers), 'devicestatus')
+
+
+def get_ns_treatments(ns_url, token, file_obj, before_date, after_date,
+                      workers=1):
+    """
+    Get Nightscout treatments data, PAGE_SIZE items at a time.
+
+    Page backwards until either (a) the start point is reached (after_date
+    parameter) or (b) no older items remain or (c) Jan 2012.
+    """
+    write_json_array(file_obj, iter_ns_data(
+        'treatments', ns_url, token, before_date, after_date,
+        workers=workers), 'treatments')
+
+
+class HashingFile:
+    """
+    Binary file wrapper computing the md5 of everything written through it.
+    """
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.md5 = hashlib.md5()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.bytes_written += len(data)
+        return self.file_obj.write(data)
+
+    def flush(self):
+        self.file_obj.flush()
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def hash_existing(self):
+        """
+        Hash the file's current content, leaving the position at its end.
+        """
+        self.file_obj.seek(0)
+        for chunk in iter(lambda: self.file_obj.read(1 << 20), b''):
+            self.md5.update(chunk)
+            self.bytes_written += len(chunk)
+
+    def close(self):
+        self.file_obj.close()
+
+
+# File name suffix per supported compression.
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def open_compressed(file_obj, compression):
+    """
+    Return a binary stream compressing into file_obj (None: no compression).
+    """
+    assert compression in COMPRESSION_SUFFIXES, \
+        'Unknown compression {}'.format(compression)
+    if compression == 'gzip':
+        # Fixed mtime, so the same data always gives the same md5.
+        return gzip.GzipFile(fileobj=file_obj, mode='wb', mtime=0)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor().stream_writer(file_obj,
+                                                        closefd=False)
+    return file_obj
+
+
+def write_ndjson(stream, pages, data_type):
+    """
+    Write pages of items to a binary stream, one JSON document per line.
+
+    Return the number of items written.
+    """
+    count = 0
+    for items in pages:
+        if items:
+            stream.write(nscodec.dumps_lines(items))
+            count += len(items)
+        logger.debug('Wrote {} {} items to file...'.format(
+            len(items), data_type))
+    logger.debug('Done writing {} items to file.'.format(data_type))
+    return count
+
+
+def load_checkpoint(checkpoint_path, params):
+    """
+    Return the checkpoint of a download with the same params, if any.
+    """
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('params') != params:
+        logger.info('Ignoring checkpoint {} of other params'.format(
+            checkpoint_path))
+        return None
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
 
 
 def ns_data_file(data_type, tempdir, ns_url, token,
-                 before_date, after_date):
+                 before_date, after_date, workers=1, compression='gzip',
+                 resume=False, pseudonym_key=None, perf=NULL_RECORDER):
     """
     Retrieve data from a Nightscout URL, before and after dates.
 
+    Data is streamed to a newline-delimited JSON file, compressed with
+    gzip or zstd (or None), and its md5 computed as it is written.
+    After each page a checkpoint records the file length and the oldest
+    item written; with resume, an interrupted download continues from its
+    checkpoint instead of starting over. Pseudonyms are keyed on
+    pseudonym_key (default the key kept in tempdir), so a resumed file keeps
+    those already written.
     Return path to file and metadata, to be loaded in Open Humans.
     """
     assert data_type in ['treatments', 'profile', 'entries', 'devicestatus']
 
-    logger.debug('Initializing {}.json.gz file...'.format(data_type))
-    filepath = os.path.join(tempdir, '{}'.format(data_type) + '_' + after_date + '_to_' + before_date + '.json')
-    file_obj = open(filepath, 'w')
+    suffix = '.ndjson' + COMPRESSION_SUFFIXES[compression]
+    logger.debug('Initializing {}{} file...'.format(data_type, suffix))
+    filepath = os.path.join(tempdir, '{}_{}_to_{}{}'.format(
+        data_type, after_date or 'start', before_date, suffix))
+    checkpoint_path = filepath + '.ckpt'
+    params = {'data_type': data_type, 'before_date': before_date,
+              'after_date': after_date, 'compression': compression}
+
+    checkpoint = None
+    if resume and data_type != 'profile' and os.path.exists(filepath):
+        checkpoint = load_checkpoint(checkpoint_path, params)
+    if checkpoint:
+        logger.info('Resuming {} from {}'.format(data_type,
+                                                 checkpoint['cursor']))
+        raw_file = open(filepath, 'r+b')
+        raw_file.truncate(checkpoint['offset'])
+        file_obj = HashingFile(raw_file)
+        file_obj.hash_existing()
+        fetch_before = checkpoint['cursor']
+        skip_ids = set(checkpoint['boundary_ids'])
+        records = checkpoint['records']
+    else:
+        file_obj = HashingFile(open(filepath, 'wb'))
+        fetch_before = before_date
+        skip_ids = set()
+        records = 0
 
     logger.info('Retrieving NS {}'.format(data_type))
 
-    # A single query works for sparse data.
-    if data_type == 'profile':
-        ns_data_url = ns_url + '/api/v1/profile.json'
-        ns_params = {'count': 1000000}
-        ns_params['token'] = token
-        data_req = requests.get(ns_data_url, params=ns_params)
-        if data_req.json():
-            json.dump(data_req.json(), file_obj)
-    elif data_type == 'treatments':
-        get_ns_treatments(ns_url, token, file_obj, before_date, after_date)
-    elif data_type == 'entries':
-        get_ns_entries(ns_url, token, file_obj, before_date, after_date)
-    elif data_type == 'devicestatus':
-        get_ns_devicestatus(ns_url, token, file_obj, before_date, after_date)
-
-    logger.debug('Closing {}.json.gz file...'.format(data_type))
-    file_obj.close()
+    if pseudonym_key is None:
+        pseudonym_key = resolve_pseudonym_key(tempdir)
+    previous_items = []
+    for items in iter_ns_data(data_type, ns_url, token, fetch_before,
+                              after_date, workers=workers,
+                              pseudonym_key=pseudonym_key, perf=perf):
+        if skip_ids:
+            items = [item for item in items if item.get('_id') not in skip_ids]
+        if not items:
+            continue
+        # Each page is a complete gzip member/zstd frame, so the file can be
+        # truncated back to any checkpoint and appended to.
+        stream = open_compressed(file_obj, compression)
+        records += write_ndjson(stream, [items], data_type)
+        if compression:
+            stream.close()
+        if data_type == 'profile':
+            continue
+        file_obj.flush()
+        os.fsync(file_obj.fileno())
 
-    md5 = hashlib.md5()
-    with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5.update(chunk)
-    md5_hex = md5.hexdigest()
+        # Resume at the second of the oldest item, skipping those written.
+        oldest = nscache.doc_time_ms(items[-1], data_type)
+        if oldest is None:
+            continue
+        boundary = oldest // 1000 * 1000
+        save_checkpoint(checkpoint_path, {
+            'params': params,
+            'offset': file_obj.bytes_written,
+            'records': records,
+            'cursor': nscache.ms_to_iso(oldest),
+            'boundary_ids': [
+                item.get('_id') for item in previous_items + items
+                if (nscache.doc_time_ms(item, data_type) or 0) >= boundary],
+        })
+        previous_items = items
+
+    logger.debug('Closing {}{} file...'.format(data_type, suffix))
+    file_obj.close()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
     metadata = {
-        'tags': ['json'],
+        'tags': ['ndjson'] + ([compression] if compression else []),
         'description': 'Nightscout {} data'.format(data_type),
-        'md5': md5_hex,
+        'md5': file_obj.md5.hexdigest(),
+        'bytes': file_obj.bytes_written,
+        'records': records,
         'end_date': arrow.get(before_date).format('YYYY-MM-DD'),
     }
     if after_date:
@@ -329,33 +954,255 @@ def ns_data_file(data_type, tempdir, ns_url, token,
     return filepath, metadata
 
 
-def ns_data(data_type, ns_url, token, before_date, after_date):
+def flatten_dict(value, prefix='', flat=None):
+    """
+    Flatten nested dicts to 'parent.child' keys, as pd.json_normalize does.
+    """
+    if flat is None:
+        flat = dict()
+    if not isinstance(value, dict):
+        return flat
+    for key, child in value.items():
+        if isinstance(child, dict):
+            flatten_dict(child, prefix + key + '.', flat)
+        else:
+            flat[prefix + key] = child
+    return flat
+
+
+def flatten_record(value):
+    """
+    Flatten one record like pd.json_normalize: top-level scalars come first.
+    """
+    if not isinstance(value, dict):
+        return dict()
+    flat = {key: child for key, child in value.items()
+            if not isinstance(child, dict)}
+    for key, child in value.items():
+        if isinstance(child, dict):
+            flatten_dict(child, key + '.', flat)
+    return flat
+
+
+def flatten_chunk(values):
+    """
+    Flatten nested dicts into a frame of their columns.
+
+    Runs in worker processes; frames are pickled back to the caller.
+    """
+    return pd.DataFrame.from_records([flatten_record(value) for value in values])
+
+
+def flatten_pool(processes):
+    """
+    Return the shared pool of processes flattening records.
+    """
+    global _flatten_pool
+    with _flatten_pool_lock:
+        pool_processes, executor = _flatten_pool
+        if pool_processes != processes:
+            if executor is not None:
+                executor.shutdown(wait=False)
+            # Spawned, not forked: callers may run threads holding locks.
+            executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'))
+            _flatten_pool = (processes, executor)
+        return executor
+
+
+def is_date_column(name):
+    """
+    Return whether pd.read_json would treat a column as date-like.
+    """
+    name = str(name).lower()
+    return (name.endswith(('_at', '_time')) or name.startswith('timestamp')
+            or name in ('modified', 'date', 'datetime'))
+
+
+def convert_dates(df):
+    """
+    Convert date-like columns to datetimes, as pd.read_json does by default.
+
+    Numeric columns are epoch milliseconds; strings are parsed to UTC.
+    Columns that fail to parse are left untouched.
+    """
+    for col in [col for col in df.columns if is_date_column(col)]:
+        try:
+            if pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = pd.to_datetime(df[col], unit='ms')
+            else:
+                df[col] = pd.to_datetime(df[col], utc=True)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return df
+
+
+def records_to_frame(pages, flatten=(), processes=1, perf=NULL_RECORDER):
+    """
+    Build a dataframe from pages of records in one step.
+
+    Each field in flatten holds nested dicts; these are flattened page by
+    page and appended as extra columns, like pd.json_normalize(df[field]).
+    With processes > 1, pages after the first are flattened in that many
+    worker processes while later pages are still being fetched.
+    """
+    records = []
+    flat_frames = {field: [] for field in flatten}
+    for items in pages:
+        with perf.stage('flatten', records=len(items)):
+            for field in flatten:
+                values = [item.get(field) for item in items]
+                if processes > 1 and records:
+                    flat_frames[field].append(
+                        flatten_pool(processes).submit(flatten_chunk, values))
+                else:
+                    flat_frames[field].append(flatten_chunk(values))
+            records.extend(items)
+    if not records:
+        return pd.DataFrame()
+
+    with perf.stage('flatten.wait'):
+        # Concatenated in page order, columns keep their first-seen order.
+        flat_frames = {field: [frame if isinstance(frame, pd.DataFrame)
+                               else frame.result() for frame in frames]
+                       for field, frames in flat_frames.items()}
+    with perf.stage('build_frame', records=len(records)):
+        df = convert_dates(pd.DataFrame.from_records(records))
+        del records
+        if flatten:
+            df = pd.concat([df] + [
+                pd.concat(flat_frames.pop(field), ignore_index=True, sort=False)
+                for field in flatten], axis=1)
+    return df
+
+
+def ns_cached_documents(data_type, ns_url, token, before_date, after_date,
+                        cache_dir, workers=1, api='v1', fields=None,
+                        pseudonym_key=None, perf=NULL_RECORDER):
+    """
+    Return documents between dates, fetching only ranges not already cached.
+
+    The on-disk store records which UTC intervals are held per site, token
+    and data type; only the missing sub-intervals are queried and merged in.
+
+    With api 'v3' the store is first brought up to date from the history of
+    changes since the last sync, which also completes it up to now; a store
+    of other fields is fetched again. Pseudonyms are keyed on pseudonym_key
+    (default the key kept in cache_dir), as cached ones must match those of
+    later fetches, after restarts too.
+    """
+    start = nscache.to_ms(after_date)
+    end = nscache.to_ms(before_date)
+    if pseudonym_key is None:
+        pseudonym_key = resolve_pseudonym_key(cache_dir)
+    # Never mark the future as held, or later data would never be fetched.
+    now = nscache.to_ms(arrow.utcnow())
+    held_until = now if api == 'v3' else now - nscache.UPLOAD_MARGIN_MS
+    nscache.prune(cache_dir)
+
+    # Concurrent callers of a site and data type wait for each other, so an
+    # overlapping range is fetched once and then served from the store.
+    lock = nscache.store_lock(cache_dir, ns_url, data_type, api, token)
+    with perf.stage('cache_lock.' + data_type):
+        lock.acquire()
+    try:
+        with perf.stage('cache_load.' + data_type):
+            intervals, docs = nscache.load_store(cache_dir, ns_url, data_type,
+                                                 api, token)
+        changed = False
+        covered = intervals
+        if api == 'v3':
+            projection = v3_fields(data_type, fields)
+            sync = nscache.load_sync(cache_dir, ns_url, data_type, api,
+                                     token)
+            if sync.get('fields') != projection:
+                # Other fields, or no sync state: refetch all of the range.
+                intervals, covered, docs = [], [], dict()
+            elif 'last_modified' in sync:
+                for items in iter_ns_history(data_type, ns_url, token,
+                                             sync['last_modified'],
+                                             fields=fields,
+                                             pseudonym_key=pseudonym_key,
+                                             perf=perf):
+                    changed |= nscache.add_documents(docs, items,
+                                                     data_type) > 0
+                # Anything dated since the last sync, up to now or later, is a
+                # change since then.
+                intervals = nscache.merge_intervals(
+                    intervals + [[sync['synced_at'], now]])
+                covered = nscache.merge_intervals(
+                    intervals + [[now, max(now, end)]])
+        gaps = nscache.missing_intervals(covered, start, end)
+        for gap_start, gap_end in gaps:
+            logger.debug('Cache miss for {} from {} to {}'.format(
+                data_type, nscache.ms_to_iso(gap_start),
+                nscache.ms_to_iso(gap_end)))
+            for items in iter_ns_data(data_type, ns_url, token,
+                                      nscache.ms_to_iso(gap_end),
+                                      nscache.ms_to_iso(gap_start),
+                                      workers=workers,
+                                      pseudonym_key=pseudonym_key, api=api,
+                                      fields=fields, perf=perf):
+                nscache.add_documents(docs, items, data_type)
+            if gap_start < held_until:
+                intervals = nscache.merge_intervals(
+                    intervals + [[gap_start, min(gap_end, held_until)]])
+            with perf.stage('cache_save.' + data_type):
+                nscache.save_store(cache_dir, ns_url, data_type, intervals,
+                                   docs, api, token)
+        # Unchanged stores are left as they are, history position included.
+        if changed and not gaps:
+            with perf.stage('cache_save.' + data_type):
+                nscache.save_store(cache_dir, ns_url, data_type, intervals,
+                                   docs, api, token)
+        if api == 'v3' and (changed or gaps):
+            nscache.save_sync(cache_dir, ns_url, data_type, api, {
+                'fields': projection,
+                'last_modified': now - HISTORY_MARGIN_MS,
+                'synced_at': now,
+            }, token)
+    finally:
+        lock.release()
+
+    return nscache.select_documents(docs, start, end)
+
+
+def ns_data(data_type, ns_url, token, before_date, after_date, cache_dir=None,
+            workers=1, flatten=(), processes=1, api='v1', fields=None,
+            pseudonym_key=None, perf=NULL_RECORDER):
     """
     Retrieve dataframe from a Nightscout URL, before and after dates.
+
+    If cache_dir is given, ranged data types are served from the on-disk
+    cache and only the missing date ranges are fetched; concurrent callers
+    with overlapping ranges then fetch the overlap once. Without it, only
+    identical requests in flight are shared. Up to workers query
+    segments are fetched concurrently. Nested dict fields named in flatten
+    are expanded into extra columns as records arrive, in up to processes
+    worker processes. With api 'v3', only fields (default V3_FIELDS) are
+    fetched, and cached data is kept current from the history of changes.
+    Pseudonyms are keyed on pseudonym_key, by default the key kept in
+    cache_dir (see resolve_pseudonym_key). Request and stage timings are
+    recorded in perf.
     """
     assert data_type in ['treatments', 'profile', 'entries', 'devicestatus']
 
-    logger.debug('Initializing {}.json.gz file...'.format(data_type))
-    file_obj = StringIO()
-
     logger.info('Retrieving NS {}'.format(data_type))
 
-    # A single query works for sparse data.
-    if data_type == 'profile':
-        ns_data_url = ns_url + '/api/v1/profile.json'
-        ns_params = {'count': 1000000}
-        ns_params['token'] = token
-        data_req = requests.get(ns_data_url, params=ns_params)
-        if data_req.json():
-            json.dump(data_req.json(), file_obj)
-    elif data_type == 'treatments':
-        get_ns_treatments(ns_url, token, file_obj, before_date, after_date)
-    elif data_type == 'entries':
-        get_ns_entries(ns_url, token, file_obj, before_date, after_date)
-    elif data_type == 'devicestatus':
-        get_ns_devicestatus(ns_url, token, file_obj, before_date, after_date)
-
-    file_obj.seek(0)
-    df = pd.read_json(file_obj)
-    file_obj.close()
-    return df
+    if pseudonym_key is None:
+        pseudonym_key = resolve_pseudonym_key(cache_dir)
+
+    if data_type != 'profile' and cache_dir and after_date:
+        docs = ns_cached_documents(data_type, ns_url, token, before_date,
+                                   after_date, cache_dir, workers=workers,
+                                   api=api, fields=fields,
+                                   pseudonym_key=pseudonym_key, perf=perf)
+        pages = (docs[i:i + PAGE_SIZE] for i in range(0, len(docs), PAGE_SIZE))
+    else:
+        pages = iter_ns_data(data_type, ns_url, token, before_date, after_date,
+                             workers=workers, pseudonym_key=pseudonym_key,
+                             api=api, fields=fields, perf=perf)
+
+    return records_to_frame(pages, flatten=flatten, processes=processes,
+                            perf=perf)
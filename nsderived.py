@@ -0,0 +1,204 @@
+"""
+Derived metrics of parsed devicestatus, declared by name.
+
+Each metric names the columns it is computed from and how far back before
+a row it looks. Metrics are evaluated with NumPy on rows sorted by time,
+and their values cached by the rows they were computed from: when rows are
+appended, only the new ones (and the rows they look back on) are computed.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from nsrollup import to_ms
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Target range of time in range, mg/dl.
+TIR_LOW = 70
+TIR_HIGH = 180
+
+
+class Metric:
+    """
+    A named formula of columns: func(times, *columns) -> values.
+
+    func gets arrays sorted on times (epoch ms) and must only look back
+    lookback_ms from each row, e.g. for window aggregates.
+    """
+
+    def __init__(self, name, depends, func, lookback_ms=0):
+        self.name = name
+        self.depends = depends
+        self.func = func
+        self.lookback_ms = lookback_ms
+
+
+# Metric name -> Metric, in the order shown.
+METRICS = OrderedDict()
+
+
+def metric(name, depends, lookback_ms=0):
+    """
+    Register the decorated function as the metric name.
+    """
+    def register(func):
+        METRICS[name] = Metric(name, depends, func, lookback_ms)
+        return func
+    return register
+
+
+def window_sums(times, values, window):
+    """
+    Return the sum and count of non-NaN values over the rows in
+    (time - window, time] up to each row.
+    """
+    valid = ~np.isnan(values)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    # Rows tied on time count up to their own position, as when appended.
+    hi = np.arange(1, len(times) + 1)
+    lo = np.minimum(np.searchsorted(times, times - window, side='right'), hi)
+    return sums[hi] - sums[lo], counts[hi] - counts[lo]
+
+
+def window_mean(times, values, window):
+    sums, counts = window_sums(times, values, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+@metric('CF', ['reason.ISF', 'reason.CR'])
+def correction_factor(times, isf, cr):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return isf / cr
+
+
+@metric('ISF.mean.24h', ['reason.ISF'], lookback_ms=DAY_MS)
+def isf_mean(times, isf):
+    return window_mean(times, isf, DAY_MS)
+
+
+@metric('tdd.mean.24h', ['reason.tdd'], lookback_ms=DAY_MS)
+def tdd_mean(times, tdd):
+    return window_mean(times, tdd, DAY_MS)
+
+
+@metric('TIR.24h', ['suggested.bg'], lookback_ms=DAY_MS)
+def time_in_range(times, bg):
+    """
+    Percent of the past day's bg readings within TIR_LOW..TIR_HIGH.
+    """
+    in_range = np.where(np.isnan(bg), np.nan,
+                        ((bg >= TIR_LOW) & (bg <= TIR_HIGH)) * 100.0)
+    return window_mean(times, in_range, DAY_MS)
+
+
+@metric('IOB.delta', ['suggested.IOB'], lookback_ms=15 * 60 * 1000)
+def iob_delta(times, iob):
+    """
+    Change of IOB since the previous loop run, if within 15 minutes.
+    """
+    delta = np.full(len(iob), np.nan)
+    recent = np.diff(times) < 15 * 60 * 1000
+    delta[1:] = np.where(recent, np.diff(iob), np.nan)
+    return delta
+
+
+class MetricCache:
+    """
+    Values of each metric by fingerprint of the rows they were computed
+    from, least recently used first. Thread-safe; meant to be shared.
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self.lock = threading.Lock()
+        # name -> fingerprint -> (row hashes, values), both sorted on time
+        self.entries = dict()
+
+    def get(self, name, hashes):
+        """
+        Return (values, rows) held for the longest leading run of rows with
+        these hashes: all of them when cached, none (None, 0) when unknown.
+        """
+        fingerprint = hashlib.md5(hashes.tobytes()).hexdigest()
+        with self.lock:
+            entries = self.entries.setdefault(name, OrderedDict())
+            if fingerprint in entries:
+                entries.move_to_end(fingerprint)
+                return entries[fingerprint][1], len(hashes)
+            held = list(entries.values())
+        best = (None, 0)
+        for held_hashes, values in held:
+            rows = len(held_hashes)
+            if best[1] < rows < len(hashes) \
+                    and np.array_equal(hashes[:rows], held_hashes):
+                best = (values, rows)
+        return best
+
+    def put(self, name, hashes, values):
+        fingerprint = hashlib.md5(hashes.tobytes()).hexdigest()
+        with self.lock:
+            entries = self.entries.setdefault(name, OrderedDict())
+            entries[fingerprint] = (hashes, values)
+            entries.move_to_end(fingerprint)
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+
+def available(columns, suffix=''):
+    """
+    Return the names of the metrics whose columns (with suffix) are all in
+    columns. Only row-wise metrics apply to rollups (suffix '.mean').
+    """
+    return [name for name, m in METRICS.items()
+            if all(col + suffix in columns for col in m.depends)
+            and (not suffix or m.lookback_ms == 0)]
+
+
+def derive(df, names=None, suffix='', cache=None, time_col='created_at'):
+    """
+    Return a frame of metric columns (name + suffix) for the rows of df,
+    with its index. All available metrics if names is None.
+
+    With a MetricCache, values already computed for the same rows are
+    reused, and after rows are added only the new ones are computed.
+    """
+    names = available(df.columns, suffix) if names is None else names
+    if len(df) == 0:
+        return pd.DataFrame({name + suffix: pd.Series(dtype='float32')
+                             for name in names}, index=df.index)
+    times = to_ms(df[time_col]).values
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    columns = dict()
+    for name in names:
+        m = METRICS[name]
+        depends = [col + suffix for col in m.depends]
+        values, rows = None, 0
+        if cache is not None:
+            hashes = pd.util.hash_pandas_object(
+                df[[time_col] + depends], index=False).values[order]
+            values, rows = cache.get(name, hashes)
+        if rows < len(times):
+            # New rows, and the ones before them they look back on.
+            start = 0
+            if rows:
+                start = np.searchsorted(times, times[rows] - m.lookback_ms,
+                                        side='left')
+            inputs = [pd.to_numeric(df[col], errors='coerce').to_numpy(
+                dtype='float64')[order][start:] for col in depends]
+            computed = np.asarray(m.func(times[start:], *inputs),
+                                  dtype='float32')[rows - start:]
+            values = computed if values is None else np.concatenate(
+                [values, computed])
+            if cache is not None:
+                cache.put(name, hashes, values)
+        result = np.empty(len(values), dtype='float32')
+        result[order] = values
+        columns[name + suffix] = result
+    return pd.DataFrame(columns, index=df.index)
@@ -0,0 +1,214 @@
+"""
+Export Nightscout data of one or many sites to compressed NDJSON files, or
+to Parquet / Arrow files partitioned by site, data type and day.
+
+All data types of all sites are fetched concurrently, e.g.:
+
+    python nsexport.py --site https://a.example.com,TOKEN --site b.example.com \
+        --after 2022-01-01 --before 2022-02-01 --out archive --compression zstd
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import arrow
+
+import nsarrow
+import nsreason
+from nsdata import (COMPRESSION_SUFFIXES, iter_ns_data, ns_data_file,
+                    records_to_frame, resolve_pseudonym_key)
+
+DATA_TYPES = ['entries', 'devicestatus', 'treatments', 'profile']
+
+FORMATS = ['ndjson'] + list(nsarrow.FORMATS)
+
+# Nested fields flattened into columns of their own in columnar formats.
+FLATTEN = {'devicestatus': ['pump', 'openaps']}
+
+logger = logging.getLogger(__name__)
+
+
+def parse_site(value):
+    """
+    Split a "URL[,TOKEN]" argument into a normalized URL and token.
+    """
+    url, _, token = value.partition(',')
+    if not url.startswith('http'):
+        url = 'https://' + url
+    return url.rstrip('/'), token
+
+
+def site_dir(out_dir, ns_url):
+    return os.path.join(out_dir, urlparse(ns_url).netloc.replace(':', '_'))
+
+
+def columnar_frame(ns_url, token, data_type, before_date, after_date,
+                   workers=1, processes=1, pseudonym_key=None):
+    """
+    Fetch data as stored in columnar formats: flattened (in up to processes
+    worker processes), without the nested fields, and for devicestatus with
+    the reason.* columns the viewer parses.
+    """
+    flatten = FLATTEN.get(data_type, [])
+    df = records_to_frame(iter_ns_data(data_type, ns_url, token, before_date,
+                                       after_date, workers=workers,
+                                       pseudonym_key=pseudonym_key),
+                          flatten=flatten, processes=processes)
+    df = df.drop(columns=[field for field in flatten if field in df.columns])
+    if data_type == 'devicestatus':
+        df = nsreason.add_reason_columns(df)
+    return df
+
+
+def export_columnar(out_dir, ns_url, token, data_type, before_date,
+                    after_date, storage_format, workers, processes=1,
+                    pseudonym_key=None):
+    """
+    Fetch data as columnar_frame does, then merge it into day partitions
+    under out_dir.
+
+    Return (partition root, metadata).
+    """
+    df = columnar_frame(ns_url, token, data_type, before_date, after_date,
+                        workers=workers, processes=processes,
+                        pseudonym_key=pseudonym_key)
+    paths = nsarrow.write_partitions(df, out_dir, ns_url, data_type,
+                                     storage_format)
+    metadata = {
+        'tags': [storage_format],
+        'bytes': sum(os.path.getsize(path) for path in paths),
+        'records': len(df),
+        'partitions': len(paths),
+        'end_date': before_date,
+        'start_date': after_date,
+    }
+    return nsarrow.partition_root(out_dir, ns_url, data_type), metadata
+
+
+def export_one(out_dir, ns_url, token, data_type, before_date, after_date,
+               compression, workers, resume, storage_format='ndjson',
+               processes=1, pseudonym_key=None):
+    start = time.perf_counter()
+    if storage_format == 'ndjson':
+        directory = site_dir(out_dir, ns_url)
+        os.makedirs(directory, exist_ok=True)
+        filepath, metadata = ns_data_file(
+            data_type, directory, ns_url, token, before_date, after_date,
+            workers=workers, compression=compression, resume=resume,
+            pseudonym_key=pseudonym_key)
+    else:
+        filepath, metadata = export_columnar(
+            out_dir, ns_url, token, data_type, before_date, after_date,
+            storage_format, workers, processes, pseudonym_key)
+    metadata['site'] = ns_url
+    metadata['data_type'] = data_type
+    metadata['file'] = os.path.relpath(filepath, out_dir)
+    metadata['seconds'] = round(time.perf_counter() - start, 3)
+    return metadata
+
+
+def export(sites, data_types, out_dir, before_date, after_date,
+           compression='gzip', jobs=4, workers=1, resume=False,
+           storage_format='ndjson', processes=1):
+    """
+    Export each data type of each (url, token) site, jobs at a time.
+
+    With resume, interrupted NDJSON downloads continue from their checkpoints;
+    columnar partitions are merged by _id, so they are simply exported again.
+    Pseudonyms are keyed on the key kept in out_dir, so they match across
+    files and runs.
+
+    Return (metadata of exported files, list of (site, data type, error)).
+    """
+    pseudonym_key = resolve_pseudonym_key(out_dir)
+    exported = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(export_one, out_dir, ns_url, token, data_type,
+                            before_date, after_date, compression,
+                            workers, resume, storage_format, processes,
+                            pseudonym_key): (ns_url, data_type)
+            for ns_url, token in sites for data_type in data_types}
+        for future in as_completed(futures):
+            ns_url, data_type = futures[future]
+            try:
+                metadata = future.result()
+            except Exception as e:
+                logger.exception('Failed exporting {} of {}'.format(
+                    data_type, ns_url))
+                failed.append((ns_url, data_type, repr(e)))
+                continue
+            logger.info('Exported {} of {}: {} records, {} bytes'.format(
+                data_type, ns_url, metadata['records'], metadata['bytes']))
+            exported.append(metadata)
+    return exported, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--site', action='append', required=True,
+                        help='Nightscout URL, optionally followed by ,TOKEN '
+                             '(repeat for more sites)')
+    parser.add_argument('--type', action='append', choices=DATA_TYPES,
+                        help='data type to export (default: all)')
+    parser.add_argument('--after', required=True,
+                        help='start date, e.g. 2022-01-01')
+    parser.add_argument('--before', default=arrow.utcnow().shift(days=1).format('YYYY-MM-DD'),
+                        help='end date (default: tomorrow, UTC)')
+    parser.add_argument('--out', default='.', help='output directory')
+    parser.add_argument('--format', default='ndjson', choices=FORMATS,
+                        help='ndjson files, or parquet / arrow files '
+                             'partitioned by site, data type and day')
+    parser.add_argument('--compression', default='gzip',
+                        choices=[c for c in COMPRESSION_SUFFIXES if c] + ['none'],
+                        help='ndjson compression (columnar files use their own)')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='files exported concurrently')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='concurrent queries per file')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes flattening devicestatus of columnar '
+                             'formats')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue interrupted downloads from checkpoints')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream=sys.stderr)
+    compression = None if args.compression == 'none' else args.compression
+    sites = [parse_site(site) for site in args.site]
+
+    start = time.perf_counter()
+    exported, failed = export(sites, args.type or DATA_TYPES, args.out,
+                              args.before, args.after, compression=compression,
+                              jobs=args.jobs, workers=args.workers,
+                              resume=args.resume, storage_format=args.format,
+                              processes=args.processes)
+    manifest = {
+        'before': args.before,
+        'after': args.after,
+        'format': args.format,
+        'compression': compression,
+        'seconds': round(time.perf_counter() - start, 3),
+        'bytes': sum(metadata['bytes'] for metadata in exported),
+        'files': sorted(exported, key=lambda m: m['file']),
+        'failed': failed,
+    }
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logger.info('Exported {} files ({} bytes) in {}s, {} failed'.format(
+        len(exported), manifest['bytes'], manifest['seconds'], len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
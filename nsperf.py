@@ -0,0 +1,114 @@
+"""
+Lightweight timing and metrics of fetch requests and pipeline stages.
+"""
+import contextlib
+import json
+import threading
+import time
+
+# Counted fields summed per stage, besides duration.
+COUNTED_FIELDS = ['bytes', 'wire_bytes', 'records', 'retries', 'coalesced',
+                  'wait_s']
+
+
+class PerfRecorder:
+    """
+    Thread-safe collector of stage events: name, duration and counts.
+
+    A disabled recorder measures nothing, so code can always record.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._events = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the enclosed block as one event of stage name.
+
+        Yields the event dict, so the block can add counts (bytes, records,
+        retries) or other fields to it.
+        """
+        event = dict(fields)
+        if not self.enabled:
+            yield event
+            return
+        event['start'] = time.time()
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException:
+            event['error'] = True
+            raise
+        finally:
+            event['stage'] = name
+            event['duration_s'] = time.perf_counter() - start
+            self.add(event)
+
+    def add(self, event):
+        if self.enabled:
+            with self._lock:
+                self._events.append(event)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def summary(self):
+        """
+        Return per stage totals: count, duration_s and counted fields.
+        """
+        totals = dict()
+        for event in self.events():
+            total = totals.setdefault(event['stage'], dict(
+                count=0, duration_s=0.0, errors=0,
+                **{field: 0 for field in COUNTED_FIELDS}))
+            total['count'] += 1
+            total['duration_s'] += event['duration_s']
+            total['errors'] += int(event.get('error', False))
+            for field in COUNTED_FIELDS:
+                total[field] += event.get(field, 0)
+        return totals
+
+    def to_log_lines(self):
+        """
+        Return one JSON object per event, as structured log lines.
+        """
+        return [json.dumps(event, default=str, sort_keys=True)
+                for event in self.events()]
+
+    def log(self, logger):
+        for line in self.to_log_lines():
+            logger.info(line)
+
+    def to_prometheus(self, prefix='nsview'):
+        """
+        Return stage totals in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        metrics = [
+            ('stage_runs_total', 'Stage executions.', 'count'),
+            ('stage_duration_seconds_total', 'Time spent per stage.',
+             'duration_s'),
+            ('stage_errors_total', 'Stage executions that raised.', 'errors'),
+        ] + [('stage_{}_total'.format(field), 'Total {} per stage.'.format(
+            field), field) for field in COUNTED_FIELDS]
+        lines = []
+        for name, help_text, field in metrics:
+            metric = '{}_{}'.format(prefix, name)
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            for stage, total in sorted(summary.items()):
+                lines.append('{}{{stage="{}"}} {}'.format(
+                    metric, escape_label(stage), total[field]))
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Shared recorder for callers that don't collect metrics.
+NULL_RECORDER = PerfRecorder(enabled=False)
@@ -0,0 +1,85 @@
+"""
+Parsing of the numeric values in openaps reason strings.
+
+Kept apart from the viewer so exports can store the parsed reason.* columns
+next to the raw suggested.reason.
+"""
+import re
+
+import pandas as pd
+
+COLS_REASON_NUM = ['ISF',
+                   'CR',
+                   'Target',
+                   'tdd',
+                   'circadian_sensitivity',
+                   'Dev',
+                   'BGI',
+                   'aimi_bg',
+                   'aimi_delta',
+                   'DiaSMB',
+                   'DiaManualBolus',
+                   'MagicNumber',
+                   'smbRatio',
+                   'limitIOB',
+                   'bgDegree'
+                   ]
+
+# Numeric "Key: value," pairs in openaps reason strings
+REASON_PAIR_RE = re.compile(r'([A-Za-z_]\w*)\s?: ([\d.\s-]*),')
+
+
+def reason_key_names(key):
+    # Known names match on the key suffix, case insensitive, as "ISF" in "ISF: 40,"
+    names = [name for name in COLS_REASON_NUM
+             if key.lower().endswith(name.lower())]
+    return names if names else [key]
+
+
+def parse_reason(reason):
+    """
+    Extract all numeric "Key: value," pairs of the reason strings in one pass.
+
+    Returns a frame with a "reason.<name>" column for each of COLS_REASON_NUM,
+    followed by one for any other key found. The first occurrence in each
+    reason wins.
+    """
+    key_names = {}
+    records = []
+    for text in reason:
+        record = {}
+        if isinstance(text, str):
+            for key, value in REASON_PAIR_RE.findall(text):
+                if key not in key_names:
+                    key_names[key] = reason_key_names(key)
+                for name in key_names[key]:
+                    record.setdefault(name, value)
+        records.append(record)
+    values = pd.DataFrame.from_records(records, index=reason.index)
+
+    extra_names = [name for name in values.columns
+                   if name not in COLS_REASON_NUM]
+    columns = {}
+    for name in COLS_REASON_NUM + extra_names:
+        if name not in values.columns:
+            columns['reason.' + name] = pd.Series(float('nan'),
+                                                  index=reason.index)
+            continue
+        col = pd.to_numeric(values[name], errors='coerce')
+        if name in COLS_REASON_NUM or col.notna().any():
+            columns['reason.' + name] = col
+    return pd.DataFrame(columns, index=reason.index)
+
+
+def add_reason_columns(df):
+    """
+    Return df with the reason.* columns parsed from suggested.reason.
+
+    Rows without an openaps payload (e.g. only pump or uploader status), or
+    frames without any, get empty ones.
+    """
+    if 'suggested.reason' in df.columns:
+        reason = df['suggested.reason']
+    else:
+        reason = pd.Series(None, index=df.index, dtype=object)
+    return pd.concat([df, parse_reason(reason)], axis=1)
@@ -0,0 +1,170 @@
+"""
+Time-bucket rollups of parsed devicestatus, for ranges too long to plot raw.
+
+Per site and resolution, buckets hold min, max, sum and count of each
+numeric reason.* and suggested.* column, and of columns joined from other
+streams. Only complete buckets are stored, with the intervals they cover, so
+rollups grow incrementally as data is fetched and re-fetching a range just
+replaces its buckets.
+"""
+import os
+import pickle
+import tempfile
+
+import pandas as pd
+
+import nscache
+
+# Resolution name -> bucket width in milliseconds, finest first.
+RESOLUTIONS = {
+    '5min': 5 * 60 * 1000,
+    'hour': 60 * 60 * 1000,
+    'day': 24 * 60 * 60 * 1000,
+}
+
+# Expected interval of raw devicestatus rows (one per loop run).
+RAW_INTERVAL_MS = 5 * 60 * 1000
+
+# Columns rolled up, by name prefix: parsed and joined from other streams.
+ROLLUP_PREFIXES = ('reason.', 'suggested.', 'entries.', 'treatments.')
+
+STATS = ['min', 'max', 'sum', 'count']
+
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+def choose_resolution(start_ms, end_ms, max_points):
+    """
+    Return the finest resolution with at most max_points buckets in the
+    range, or None if raw rows fit.
+    """
+    span = end_ms - start_ms
+    if span <= RAW_INTERVAL_MS * max_points:
+        return None
+    for name, width in RESOLUTIONS.items():
+        if span <= width * max_points:
+            return name
+    return name
+
+
+def rollup_columns(df):
+    return [col for col in df.columns if col.startswith(ROLLUP_PREFIXES)
+            and pd.api.types.is_numeric_dtype(df[col])
+            and not pd.api.types.is_bool_dtype(df[col])]
+
+
+def to_ms(dates):
+    """
+    Convert a series of datetimes, naive ones being UTC, to epoch milliseconds.
+    """
+    dates = pd.to_datetime(dates, utc=True)
+    return ((dates - EPOCH) // pd.Timedelta(milliseconds=1)).astype('int64')
+
+
+def bucket_stats(df, width, time_col='created_at'):
+    """
+    Return stats of df per bucket of width ms, indexed by bucket start ms.
+
+    Columns are a (stat, column) MultiIndex.
+    """
+    buckets = to_ms(df[time_col]) // width * width
+    values = df[rollup_columns(df)].astype('float64')
+    grouped = values.groupby(buckets.values)
+    stats = pd.concat({stat: getattr(grouped, stat)() for stat in STATS},
+                      axis=1)
+    return stats.astype('float32')
+
+
+def rollup_path(cache_dir, ns_url, resolution, token=''):
+    return os.path.join(cache_dir, nscache.site_key(ns_url, token), 'rollups',
+                        resolution + '.pkl')
+
+
+def load_rollup(cache_dir, ns_url, resolution, token=''):
+    """
+    Load covered intervals and stats of a site's rollup.
+    """
+    path = rollup_path(cache_dir, ns_url, resolution, token)
+    try:
+        with open(path, 'rb') as f:
+            rollup = pickle.load(f)
+        nscache.touch(path)
+        return rollup['intervals'], rollup['stats']
+    except (OSError, KeyError, pickle.UnpicklingError, EOFError):
+        return [], None
+
+
+def save_rollup(cache_dir, ns_url, resolution, intervals, stats, token=''):
+    path = rollup_path(cache_dir, ns_url, resolution, token)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'intervals': intervals, 'stats': stats}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def full_buckets(start_ms, end_ms, width):
+    """
+    Return the [start, end) span of the buckets lying within the range.
+    """
+    return -(-start_ms // width) * width, end_ms // width * width
+
+
+def update_rollups(cache_dir, ns_url, df, start_ms, end_ms, token=''):
+    """
+    Roll up df, parsed devicestatus holding all rows in (start_ms, end_ms].
+
+    Buckets lying within the range replace stored ones; partial buckets at
+    either end, and buckets still open to late uploads, are left out.
+    """
+    end_ms = min(end_ms, nscache.to_ms(pd.Timestamp.now(tz='UTC'))
+                 - nscache.UPLOAD_MARGIN_MS)
+    for resolution, width in RESOLUTIONS.items():
+        lo, hi = full_buckets(start_ms, end_ms, width)
+        if hi <= lo:
+            continue
+        stats = bucket_stats(df, width)
+        stats = stats[(stats.index >= lo) & (stats.index < hi)]
+        intervals, stored = load_rollup(cache_dir, ns_url, resolution, token)
+        if stored is not None:
+            stored = stored[(stored.index < lo) | (stored.index >= hi)]
+            stats = pd.concat([stored, stats]).sort_index()
+        intervals = nscache.merge_intervals(intervals + [[lo, hi]])
+        save_rollup(cache_dir, ns_url, resolution, intervals, stats, token)
+
+
+def read_rollup(cache_dir, ns_url, resolution, start_ms, end_ms, token=''):
+    """
+    Return the rollup frame of a range, or None unless its buckets are held.
+
+    Ranges reaching now are not read: the bucket in progress is never
+    stored, and must come from raw rows.
+    """
+    if end_ms >= nscache.to_ms(pd.Timestamp.now(tz='UTC')):
+        return None
+    width = RESOLUTIONS[resolution]
+    lo, hi = full_buckets(start_ms, end_ms, width)
+    intervals, stats = load_rollup(cache_dir, ns_url, resolution, token)
+    if stats is None or (hi > lo and nscache.missing_intervals(
+            intervals, lo, hi)):
+        return None
+    stats = stats[(stats.index >= start_ms // width * width)
+                  & (stats.index < end_ms)]
+    return rollup_frame(stats)
+
+
+def rollup_frame(stats):
+    """
+    Return stats as a flat frame, newest first: created_at (bucket start)
+    and <column>.mean/.min/.max/.count columns.
+    """
+    df = pd.DataFrame(
+        {'created_at': pd.to_datetime(stats.index, unit='ms', utc=True)})
+    for col in stats['count'].columns:
+        count = stats['count'][col]
+        df[col + '.mean'] = (stats['sum'][col] / count.where(count > 0)).values
+        df[col + '.min'] = stats['min'][col].values
+        df[col + '.max'] = stats['max'][col].values
+        df[col + '.count'] = count.values
+    return df.iloc[::-1].reset_index(drop=True)
@@ -0,0 +1,130 @@
+"""
+Nightscout streams kept sorted on UTC time, with as-of and window joins.
+
+Each stream is sorted once, on epoch milliseconds, so joining its values
+onto loop decisions takes binary searches instead of merges of unsorted
+frames.
+"""
+import numpy as np
+import pandas as pd
+
+from nsrollup import to_ms
+
+# Stream -> UTC time column.
+TIME_COLS = {
+    'devicestatus': 'created_at',
+    'entries': 'date',
+    'treatments': 'created_at',
+}
+
+# (stream, column, tolerance ms): nearest value within tolerance.
+ASOF_JOINS = [
+    ('entries', 'sgv', 5 * 60 * 1000),
+]
+
+# (stream, column, window ms, label): sum over the preceding window.
+WINDOW_SUMS = [
+    ('treatments', 'carbs', 3 * 60 * 60 * 1000, '3h'),
+    ('treatments', 'insulin', 3 * 60 * 60 * 1000, '3h'),
+]
+
+# Streams joined, and how far before the first row they are needed.
+JOINED_STREAMS = sorted({join[0] for join in ASOF_JOINS + WINDOW_SUMS})
+LOOKBACK_MS = max([join[2] for join in ASOF_JOINS + WINDOW_SUMS])
+
+
+class StreamStore:
+    """
+    Frames of each stream, oldest first, with their times in epoch ms.
+
+    A store is never modified once built: with_rows returns a new one.
+    """
+
+    def __init__(self):
+        self.streams = dict()
+        self.times = dict()
+
+    def add(self, name, df):
+        """
+        Keep df sorted on its time column; rows without a time are dropped.
+        """
+        df = df[df[TIME_COLS[name]].notna()]
+        times = to_ms(df[TIME_COLS[name]]).values
+        order = np.argsort(times, kind='stable')
+        self.streams[name] = df.iloc[order].reset_index(drop=True)
+        self.times[name] = times[order]
+
+    def with_rows(self, name, df):
+        """
+        Return a store with the rows of df added to stream name.
+
+        Rows with an _id already held are skipped.
+        """
+        store = StreamStore()
+        store.streams = dict(self.streams)
+        store.times = dict(self.times)
+        if len(df) == 0:
+            return store
+        if name in self.streams:
+            held = self.streams[name]
+            if '_id' in df.columns and '_id' in held.columns:
+                recent = self.times[name] >= to_ms(df[TIME_COLS[name]]).min()
+                df = df[~df['_id'].isin(held['_id'].values[recent])]
+            df = pd.concat([held, df], ignore_index=True)
+        store.add(name, df)
+        return store
+
+    def newest(self, name):
+        """
+        Return the time of the newest row of stream name, None if empty.
+        """
+        times = self.times.get(name)
+        return pd.Timestamp(int(times[-1]), unit='ms', tz='UTC') \
+            if times is not None and len(times) else None
+
+    def asof(self, times, name, column, tolerance, direction='nearest'):
+        """
+        Return the value of column nearest to each of times, within
+        tolerance ms; NaN where there is none.
+        """
+        df = self.streams[name]
+        has_value = df[column].notna().values
+        right = pd.DataFrame({'time': self.times[name][has_value],
+                              'value': df[column].values[has_value]})
+        order = np.argsort(times, kind='stable')
+        left = pd.DataFrame({'time': times[order]})
+        joined = pd.merge_asof(left, right, on='time', direction=direction,
+                               tolerance=tolerance)
+        values = np.empty(len(times), dtype='float64')
+        values[order] = pd.to_numeric(joined['value'], errors='coerce')
+        return values
+
+    def window_sum(self, times, name, column, window):
+        """
+        Return the sum of column over rows in (time - window, time], for
+        each of times.
+        """
+        values = pd.to_numeric(self.streams[name][column], errors='coerce')
+        cumsum = np.concatenate([[0.0], np.cumsum(values.fillna(0).values)])
+        stream_times = self.times[name]
+        hi = np.searchsorted(stream_times, times, side='right')
+        lo = np.searchsorted(stream_times, times - window, side='right')
+        return cumsum[hi] - cumsum[lo]
+
+
+def join_streams(store, df, time_col='created_at'):
+    """
+    Return stream columns for the rows of df, with its index: nearest
+    values as <stream>.<column> and window sums as <stream>.<column>.<label>.
+    """
+    times = to_ms(df[time_col]).values
+    columns = dict()
+    for name, column, tolerance in ASOF_JOINS:
+        if column in store.streams.get(name, ()):
+            columns['{}.{}'.format(name, column)] = store.asof(
+                times, name, column, tolerance)
+    for name, column, window, label in WINDOW_SUMS:
+        if column in store.streams.get(name, ()):
+            columns['{}.{}.{}'.format(name, column, label)] = \
+                store.window_sum(times, name, column, window)
+    return pd.DataFrame(columns, index=df.index)
@@ -1,35 +1,32 @@
+import hashlib
 import os
-import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import pytz
 
 import streamlit as st
-import extra_streamlit_components as stx
-from st_aggrid import AgGrid
-from st_aggrid.grid_options_builder import GridOptionsBuilder
-import plotly.graph_objects as go
-
-from nsdata import ns_data
-from utils import get_list_index
-
-
-COLS_REASON_NUM = ["ISF",
-                   "CR",
-                   "Target",
-                   "tdd",
-                   "circadian_sensitivity",
-                   "Dev",
-                   "BGI",
-                   "aimi_bg",
-                   "aimi_delta",
-                   "DiaSMB",
-                   "DiaManualBolus",
-                   "MagicNumber",
-                   "smbRatio",
-                   "limitIOB",
-                   "bgDegree"
-                   ]
+
+# Plotly, st_aggrid, extra_streamlit_components and nsdata are imported where used, so the
+# sidebar of a cold start renders without them
+import nscache
+import nscodec
+import nsderived
+import nsreason
+import nsrollup
+import nsstreams
+from nsperf import NULL_RECORDER, PerfRecorder
+from utils import get_list_index, lttb_indices
+
+
+# Raw nested columns, dropped once flattened into columns of their own
+COLS_NESTED = ["pump", "openaps"]
+
+# Strings with at most this ratio of distinct values are stored as categoricals
+MAX_CATEGORY_RATIO = 0.5
 
 COOKIE_NS_URL = "ns_url"
 COOKIE_NS_TOKEN = "ns_token"
@@ -37,72 +34,441 @@ COOKIE_TIMEZONE = "timezone"
 
 TZ_DONT_CONVERT = "Dont convert"
 
+# On-disk Nightscout data cache, kept per site and token; off unless NSVIEW_CACHE_DIR is set.
+# Sessions fetching overlapping ranges only share the overlap through it.
+CACHE_DIR = os.environ.get("NSVIEW_CACHE_DIR", "")
+
+# Partitions written by nsexport --format parquet|arrow to load devicestatus from instead of
+# Nightscout; off unless NSVIEW_PARTITIONS_DIR is set. Needs pyarrow.
+PARTITIONS_DIR = os.environ.get("NSVIEW_PARTITIONS_DIR", "")
+
+# Devicestatus columns loaded from partitions: those graphed, shown and derived from by default
+PARTITION_COLUMNS = (["_id", "created_at", "suggested.bg", "suggested.IOB", "suggested.reason"]
+                     + ["reason." + name for name in nsreason.COLS_REASON_NUM])
+
+# Nightscout API fetched from; "v3" requests only the fields used here and syncs cached data
+# from the history of changes, but needs Nightscout 14 or later
+NS_API = os.environ.get("NSVIEW_NS_API", "v1")
+
+# Number of Nightscout query windows fetched concurrently
+FETCH_WORKERS = 4
+
+# Processes flattening pump/openaps payloads of long ranges; set NSVIEW_FLATTEN_PROCESSES to use
+# more. Pickling records out and frames back costs about as much as flattening them, so more
+# only pay off with 4 or more idle cores, and at most halve the flattening time.
+FLATTEN_PROCESSES = int(os.environ.get("NSVIEW_FLATTEN_PROCESSES", "1"))
+
+# Parsed datasets kept in memory, shared by all sessions
+PARSED_CACHE_SIZE = 8
+
+# Seconds between live mode refreshes
+LIVE_INTERVALS = [15, 30, 60, 120, 300]
+
+RESOLUTION_AUTO = "Auto"
+RESOLUTION_RAW = "Raw"
+
 COLOR_COL1 = "red"
 COLOR_COL2 = "blue"
 COLOR_COL3 = "green"
 
+# Columns shown in the data grid by default
+COLS_GRID_DEFAULT = ["date", "suggested.bg", "reason.ISF", "reason.CR", "CF", "reason.tdd", "suggested.reason"]
+
+# Points drawn per graph trace, about one per pixel of a wide chart
+GRAPH_WIDTH_PX = 2000
+
 
 # @st.experimental_memo(show_spinner=False)
 def get_manager():
+    import extra_streamlit_components as stx
     return stx.CookieManager()
 
 
+def get_cookies():
+    """
+    Return (cookies, cookie manager or None): the saved settings, read from the browser once per session.
+
+    Until cookies arrive the manager is rendered on every run, as it only returns them on a later one.
+    """
+    cookies = st.session_state.get("cookies")
+    if cookies is not None:
+        return cookies, None
+    cookie_manager = get_manager()
+    cookies = dict(cookie_manager.cookies or {})
+    if cookies:
+        st.session_state["cookies"] = cookies
+    return cookies, cookie_manager
+
+
+def save_cookies(cookies, cookie_manager, settings):
+    """
+    Store the settings that differ from the saved cookies.
+    """
+    changed = {name: value for name, value in settings.items() if cookies.get(name) != value}
+    if not changed:
+        return
+    cookie_manager = cookie_manager or get_manager()
+    for name, value in changed.items():
+        cookie_manager.set(name, value, key=name + "_set")
+    st.session_state["cookies"] = {**cookies, **changed}
+
+
+@st.cache_resource
+def timezone_options():
+    return [TZ_DONT_CONVERT] + [str(tz) for tz in pytz.common_timezones]
+
+
+@st.cache_data(max_entries=PARSED_CACHE_SIZE, show_spinner=False)
+def graph_columns(columns, suffix):
+    """
+    Return the graph column options of a dataset's columns: the usual ones and derived metrics first,
+    the rest sorted.
+    """
+    cols_first = [col + suffix for col in ["suggested.bg", "reason.ISF", "reason.CR"] + list(nsderived.METRICS)]
+    cols_first = [col for col in cols_first if col in columns]  # if they exist in the data
+    return cols_first + sorted(set(columns) - set(cols_first))
+
+
+@st.cache_data(max_entries=PARSED_CACHE_SIZE, show_spinner=False)
+def grid_columns(columns):
+    """
+    Return (options, defaults) of a dataset's data grid columns.
+    """
+    defaults = [col for col in COLS_GRID_DEFAULT + [col + ".mean" for col in COLS_GRID_DEFAULT] if col in columns]
+    return list(columns), defaults
+
+
 title = "Nightscout Android APS Data Viewer"
-st.set_page_config(layout="wide", page_title=title)
-cookie_manager = get_manager()
 
 
-def get_reason_item(reason, item_name):
-    if pd.isna(reason):
+def compact_column(values):
+    """
+    Return a smaller dtype version of a column, or None to keep it as is.
+    """
+    if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+        non_null = values.dropna()
+        if len(non_null) == 0 or isinstance(non_null.iloc[0], (list, dict)):
+            return None
+        if not isinstance(non_null.iloc[0], bool) and pd.to_numeric(non_null, errors="coerce").notna().all():
+            values = pd.to_numeric(values, errors="coerce")
+        else:
+            try:
+                if non_null.nunique() <= len(non_null) * MAX_CATEGORY_RATIO:
+                    return values.astype("category")
+            except TypeError:  # Unhashable values
+                pass
+            return None
+    if pd.api.types.is_bool_dtype(values):
         return None
-    rs = re.findall(f"{item_name}[\s]{{0,1}}: ([\d.\s-]*),", reason, flags=re.I)
-    if len(rs) > 0:
-        return rs[0]
-    return None
+    if pd.api.types.is_integer_dtype(values):
+        if values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max:
+            return values.astype(np.int32)
+    elif pd.api.types.is_float_dtype(values):
+        # Only if every value survives the round trip, e.g. not 123.45 or epoch times
+        compact = values.astype(np.float32)
+        if np.array_equal(compact.to_numpy(dtype=values.dtype), values.to_numpy(), equal_nan=True):
+            return compact
+    return values
+
+
+def compact_frame(df):
+    """
+    Shrink the frame in memory: drop raw nested columns, downcast numbers to
+    32 bits where that keeps their values, and store repeated strings as
+    categoricals.
+    """
+    df = df.drop(columns=[col for col in COLS_NESTED if col in df.columns])
+    compacted = {}
+    for col in df.columns[~df.columns.duplicated(keep=False)]:
+        values = compact_column(df[col])
+        if values is not None:
+            compacted[col] = values
+    for col, values in compacted.items():
+        df[col] = values
+    return df
 
 
-def get_ns_data(ns_url, ns_token, min_date, max_date, time_zone):
-    df = ns_data("devicestatus", ns_url, ns_token, max_date, min_date)
-    if len(df) == 0:
-        return None
+def memory_report(df):
+    usage = df.memory_usage(deep=True, index=False).sort_values(ascending=False)
+    return pd.DataFrame({"bytes": usage, "dtype": df.dtypes[usage.index].astype(str)})
+
+
+def get_pseudonym_key():
+    # One device must get the same pseudonym in loaded, cached and live rows
+    from nsdata import resolve_pseudonym_key
+    return resolve_pseudonym_key(PARTITIONS_DIR or CACHE_DIR)
+
+
+def get_raw_ns_data(ns_url, ns_token, min_date, max_date, perf=NULL_RECORDER):
+    """
+    Fetch devicestatus in UTC, flattened but otherwise unparsed.
+
+    With PARTITIONS_DIR set, only PARTITION_COLUMNS are loaded from its partitions instead, reasons already parsed.
+    """
+    if PARTITIONS_DIR:
+        import nsarrow
+        with perf.stage("partitions.load") as event:
+            df = nsarrow.load_partitions(PARTITIONS_DIR, ns_url, "devicestatus", min_date, max_date,
+                                         columns=PARTITION_COLUMNS)
+            event["records"] = len(df)
+        return df
+    from nsdata import ns_data
+    return ns_data("devicestatus", ns_url, ns_token, max_date, min_date, cache_dir=CACHE_DIR,
+                   workers=FETCH_WORKERS, flatten=COLS_NESTED, processes=FLATTEN_PROCESSES, api=NS_API,
+                   pseudonym_key=get_pseudonym_key(), perf=perf)
+
+
+def get_raw_streams(ns_url, ns_token, min_date, max_date, perf=NULL_RECORDER):
+    """
+    Fetch the streams joined onto devicestatus, from far enough back for their window joins.
+    """
+    from nsdata import ns_data
+    after_date = str(pd.Timestamp(min_date) - timedelta(milliseconds=nsstreams.LOOKBACK_MS))
+    pseudonym_key = get_pseudonym_key()
+    return {name: ns_data(name, ns_url, ns_token, max_date, after_date, cache_dir=CACHE_DIR,
+                          workers=FETCH_WORKERS, api=NS_API, pseudonym_key=pseudonym_key, perf=perf)
+            for name in nsstreams.JOINED_STREAMS}
+
+
+def data_fingerprint(*frames):
+    """
+    Return a digest of the content of raw frames, so edited documents are told apart.
+
+    Raw nested columns are left out: their flattened columns are hashed already.
+    """
+    digest = hashlib.md5()
+    for df in frames:
+        for col in df.columns:
+            if col in COLS_NESTED:
+                continue
+            values = df[col]
+            digest.update(str(col).encode("utf-8"))
+            try:
+                digest.update(pd.util.hash_pandas_object(values, index=False).values.tobytes())
+            except TypeError:  # Unhashable list/dict values, serialized at once
+                try:
+                    digest.update(nscodec.dumps(values.tolist()))
+                except (TypeError, ValueError):
+                    digest.update(pd.util.hash_pandas_object(values.astype(str), index=False).values.tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+def parse_ns_data(df, perf=NULL_RECORDER):
+    """
+    Derive the timezone independent columns of a raw frame: parsed reasons, compacted dtypes.
+    """
+    # Parse other columns; partitions written by nsexport hold them already
+    if not any(col.startswith("reason.") for col in df.columns):
+        with perf.stage("parse_reason", records=len(df)):
+            df = nsreason.add_reason_columns(df)
+
+    with perf.stage("compact", records=len(df)):
+        df = compact_frame(df)
 
-    # Parse json columns (might need to handle errors and clean data)
-    df = pd.concat([df, pd.json_normalize(df.pump)], axis=1)
-    df = pd.concat([df, pd.json_normalize(df.openaps)], axis=1)
+    df = df.sort_values("created_at", ascending=False)
+    return df
 
-    # Date column (used in x axis)
-    if time_zone == TZ_DONT_CONVERT:
-        df["date"] = df["created_at"]
-    else:
-        df["date"] = df["created_at"].dt.tz_convert(tz=time_zone)
 
-    # Parse other columns
-    for col in COLS_REASON_NUM:
-        col_name = "reason." + col
-        df[col_name] = df["suggested.reason"].apply(get_reason_item, item_name=col)
-        df[col_name] = pd.to_numeric(df[col_name], errors="coerce")
+def join_ns_streams(df, store, perf=NULL_RECORDER):
+    """
+    Return a parsed frame with the columns joined from the other streams in store.
+    """
+    with perf.stage("join_streams", records=len(df)):
+        joined = compact_frame(nsstreams.join_streams(store, df))
+    return pd.concat([df, joined], axis=1)
 
-    # Calculated columns
-    df["CF"] = df["reason.ISF"].divide(df["reason.CR"])
 
-    df = df.sort_values("created_at", ascending=False)
-    return df
+def stream_store(streams):
+    store = nsstreams.StreamStore()
+    for name, df_stream in streams.items():
+        if len(df_stream) > 0:
+            store.add(name, df_stream)
+    return store
+
 
+def view_ns_data(df, time_zone, perf=NULL_RECORDER):
+    """
+    Add the view columns to a shallow copy of a parsed frame, which is left untouched.
+    """
+    df = df.copy(deep=False)
 
-@st.experimental_memo(show_spinner=False)
-def get_cached_ns_data(ns_url, ns_token, min_date, max_date, time_zone):
-    return get_ns_data(ns_url, ns_token, min_date, max_date, time_zone)
+    # Date column (used in x axis)
+    with perf.stage("dates", records=len(df)):
+        if time_zone == TZ_DONT_CONVERT:
+            df["date"] = df["created_at"]
+        else:
+            df["date"] = df["created_at"].dt.tz_convert(tz=time_zone)
+
+    # Derived metrics, also of rollup means, computed only for rows not seen before
+    with perf.stage("derive", records=len(df)):
+        for suffix in ["", ".mean"]:
+            derived = nsderived.derive(df, suffix=suffix, cache=get_metric_cache())
+            for col in derived.columns:
+                df[col] = derived[col]
+    return df
 
 
-def show_data(df):
-    gb = GridOptionsBuilder.from_dataframe(df)
-    gb.configure_pagination()
+def get_ns_data(ns_url, ns_token, min_date, max_date, time_zone, perf=NULL_RECORDER):
+    df = get_raw_ns_data(ns_url, ns_token, min_date, max_date, perf=perf)
+    if len(df) == 0:
+        return None
+    return view_ns_data(parse_ns_data(df, perf=perf), time_zone, perf=perf)
+
+
+def append_rows(df, df_new):
+    """
+    Return df_new stacked on top of df, keeping the compact dtypes of df where the new rows fit them.
+
+    Neither frame is modified.
+    """
+    df = df.copy(deep=False)
+    df_new = df_new.copy(deep=False)
+    for col in df.columns.intersection(df_new.columns):
+        dtype, new_dtype = df[col].dtype, df_new[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            values = pd.Index(df_new[col].dropna().astype(object).unique())
+            extra = values.difference(dtype.categories, sort=False)
+            if len(extra) > 0:
+                dtype = pd.CategoricalDtype(dtype.categories.append(extra))
+                df[col] = df[col].cat.set_categories(dtype.categories)
+            df_new[col] = pd.Categorical(df_new[col].astype(object), dtype=dtype)
+        elif dtype.kind == "f" and new_dtype.kind in "iuf":
+            df_new[col] = df_new[col].astype(dtype)
+        elif dtype.kind == "i" and new_dtype.kind in "iu":
+            info = np.iinfo(dtype)
+            if df_new[col].between(info.min, info.max).all():
+                df_new[col] = df_new[col].astype(dtype)
+    return pd.concat([df_new, df], ignore_index=True)
+
+
+def tail_ns_data(ns_url, ns_token, df, store=None, perf=NULL_RECORDER):
+    """
+    Return (df, store): df, a parsed frame, with the devicestatus newer than its newest row on top.
+
+    Only the new rows are fetched and parsed, so the cost follows the new data. With a stream store,
+    its streams are extended too and joined onto the new rows.
+    """
+    from nsdata import ns_data
+    newest = df["created_at"].iloc[0]
+    before = pd.Timestamp.now(tz="UTC") + timedelta(days=1)
+    pseudonym_key = get_pseudonym_key()
+    with perf.stage("live.fetch") as event:
+        df_raw = ns_data("devicestatus", ns_url, ns_token, str(before), str(newest),
+                         flatten=COLS_NESTED, api=NS_API, pseudonym_key=pseudonym_key, perf=perf)
+        if len(df_raw) > 0:
+            # Queries are bounded on whole seconds: drop rows already held
+            held = set(df.loc[df["created_at"] >= newest.floor("s"), "_id"])
+            df_raw = df_raw[~df_raw["_id"].isin(held)]
+        event["records"] = len(df_raw)
+    if len(df_raw) == 0:
+        return df, store
+    df_new = parse_ns_data(df_raw, perf=perf)
+    if store is not None:
+        for name in nsstreams.JOINED_STREAMS:
+            after_date = store.newest(name) or newest - timedelta(milliseconds=nsstreams.LOOKBACK_MS)
+            with perf.stage("live.fetch." + name):
+                store = store.with_rows(name, ns_data(name, ns_url, ns_token, str(before), str(after_date),
+                                                      api=NS_API, pseudonym_key=pseudonym_key, perf=perf))
+        df_new = join_ns_streams(df_new, store, perf=perf)
+    return append_rows(df, df_new), store
+
+
+@st.cache_resource
+def get_metric_cache():
+    # Derived metric values shared by all sessions, by the rows they were computed from
+    return nsderived.MetricCache(PARSED_CACHE_SIZE)
+
+
+@st.cache_resource
+def get_parsed_cache():
+    # Parsed frames and stream stores shared by all sessions, by raw data fingerprint, least recently used first
+    return {"lock": threading.Lock(), "frames": OrderedDict()}
+
+
+def get_parsed_ns_data(fingerprint, df_raw, streams=None, perf=NULL_RECORDER):
+    """
+    Return (parsed frame, stream store) of df_raw and streams, parsing them only once per fingerprint.
+
+    Both are shared: callers must not modify them, see view_ns_data. The store is None without streams.
+    """
+    cache = get_parsed_cache()
+    with cache["lock"]:
+        parsed = cache["frames"].get(fingerprint)
+        if parsed is not None:
+            cache["frames"].move_to_end(fingerprint)
+            return parsed
+    df = parse_ns_data(df_raw, perf=perf)
+    store = None
+    if streams is not None:
+        store = stream_store(streams)
+        df = join_ns_streams(df, store, perf=perf)
+    parsed = (df, store)
+    with cache["lock"]:
+        cache["frames"][fingerprint] = parsed
+        while len(cache["frames"]) > PARSED_CACHE_SIZE:
+            cache["frames"].popitem(last=False)
+    return parsed
+
+
+@st.fragment
+def show_data(df, perf=NULL_RECORDER):
+    from st_aggrid import AgGrid
+    from st_aggrid.grid_options_builder import GridOptionsBuilder
+
+    # Only the requested page and columns are sent to the grid
+    cols_options, cols_default = grid_columns(tuple(df.columns))
+    columns = st.multiselect("Data Columns:", cols_options, default=cols_default)
+    if not columns:
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    sort_col = col1.selectbox("Sort by:", columns, index=get_list_index(columns, "date", 0))
+    ascending = col1.checkbox("Ascending", value=False)
+    filter_col = col2.selectbox("Filter column:", columns)
+    filter_text = col2.text_input("Filter contains:")
+    page_size = col3.selectbox("Rows per page:", [25, 50, 100, 500], index=1)
+
+    rows = df[sort_col]
+    if filter_text:
+        matches = df[filter_col].astype(str).str.contains(filter_text, case=False, na=False, regex=False)
+        rows = rows[matches.to_numpy()]
+    rows = rows.sort_values(ascending=ascending, na_position="last", kind="stable")
+
+    pages = max(1, -(-len(rows) // page_size))
+    page = col4.number_input(f"Page (of {pages}):", min_value=1, max_value=pages, value=1)
+    page_index = rows.index[(page - 1) * page_size:page * page_size]
+    df_page = df.loc[page_index, columns]
+    col4.write(f"{len(rows)} of {len(df)} rows")
+
+    gb = GridOptionsBuilder.from_dataframe(df_page)
     gb.configure_side_bar()
     grid_options = gb.build()
-    AgGrid(df, gridOptions=grid_options, enable_enterprise_modules=True)
+    with perf.stage("render.grid", records=len(df_page)):
+        AgGrid(df_page, gridOptions=grid_options, enable_enterprise_modules=True)
+
+
+def downsample(x, y, max_points):
+    """
+    Downsample a trace to at most max_points, preserving its shape (LTTB).
+
+    x must be ascending. Non numeric traces are thinned evenly instead.
+    """
+    valid = y.notna().to_numpy()
+    x, y = x[valid], y[valid]
+    if len(y) <= max_points:
+        return x, y
+    if pd.api.types.is_numeric_dtype(y) and not pd.api.types.is_bool_dtype(y):
+        x_num = x.to_numpy(dtype="datetime64[ns]").astype(np.int64) if pd.api.types.is_datetime64_any_dtype(x) else x
+        idx = lttb_indices(x_num, y.to_numpy(dtype=np.float64), max_points)
+    else:
+        idx = np.linspace(0, len(y) - 1, max_points).astype(np.int64)
+    return x.iloc[idx], y.iloc[idx]
 
 
-def show_graph(df, col_name1, col_name2, col_name3):
+def build_graph(df, col_name1, col_name2, col_name3):
+    import plotly.graph_objects as go
+
     fig = go.Figure()
     fig.update_layout(
         xaxis_title="Time",
@@ -111,16 +477,18 @@ def show_graph(df, col_name1, col_name2, col_name3):
         paper_bgcolor="LightSteelBlue",
         showlegend=False,
     )
-    # Define x an ys
+    # Define x an ys, oldest first and downsampled to the chart width
+    cols = [col for col in dict.fromkeys(["date", col_name1, col_name2, col_name3]) if col != ""]
+    df = df[cols].sort_values("date")
     x = df["date"]
-    y1 = df[col_name1]
-    y2 = df[col_name2]
-    y3 = df[col_name3]  if col_name3 != "" else None
+    x1, y1 = downsample(x, df[col_name1], GRAPH_WIDTH_PX)
+    x2, y2 = downsample(x, df[col_name2], GRAPH_WIDTH_PX)
 
-    fig.add_trace(go.Scatter(x=x, y=y1, line=dict(color=COLOR_COL1)))
-    fig.add_trace(go.Scatter(x=x, y=y2, yaxis="y2", line=dict(color=COLOR_COL2)))
+    fig.add_trace(go.Scattergl(x=x1, y=y1, line=dict(color=COLOR_COL1)))
+    fig.add_trace(go.Scattergl(x=x2, y=y2, yaxis="y2", line=dict(color=COLOR_COL2)))
     if col_name3 != "":
-        fig.add_trace(go.Scatter(x=x, y=y3, yaxis="y3", line=dict(color=COLOR_COL3)))
+        x3, y3 = downsample(x, df[col_name3], GRAPH_WIDTH_PX)
+        fig.add_trace(go.Scattergl(x=x3, y=y3, yaxis="y3", line=dict(color=COLOR_COL3)))
 
     fig.update_layout(
         yaxis=dict(
@@ -163,16 +531,75 @@ def show_graph(df, col_name1, col_name2, col_name3):
                 side="left",
             )))
 
+    return fig
+
+
+def show_graph(df, col_name1, col_name2, col_name3, perf=NULL_RECORDER):
+    with perf.stage("build_graph", records=len(df)):
+        fig = build_graph(df, col_name1, col_name2, col_name3)
     # Plot graph
-    st.plotly_chart(fig, use_container_width=True)
+    with perf.stage("render.graph"):
+        st.plotly_chart(fig, use_container_width=True)
+
+
+@st.fragment
+def show_graph_section(df, suffix, perf=NULL_RECORDER):
+    """
+    Show the graph column and range selectors, then the graph.
+    """
+    # Define columns to plot
+    col1, col2, col3 = st.columns(3)
+    cols_graph = graph_columns(tuple(df.columns), suffix)
+    index1 = get_list_index(cols_graph, "suggested.bg" + suffix, 0)
+    index2 = get_list_index(cols_graph, "reason.ISF" + suffix, 1)
+
+    col_name1 = col1.selectbox("Graph Column 1:", cols_graph, index=index1)
+    col_name2 = col2.selectbox("Graph Column 2:", cols_graph, index=index2)
+    col_name3 = col3.selectbox("Graph Column 3:", [""] + cols_graph, index=0)
+
+    # Zoomed range is drawn at full resolution when it fits the chart width
+    df_graph = df
+    date_min, date_max = df["date"].min(), df["date"].max()
+    if date_min < date_max:
+        zoom_min, zoom_max = st.slider("Graph Range:", min_value=date_min.to_pydatetime().replace(tzinfo=None),
+                                       max_value=date_max.to_pydatetime().replace(tzinfo=None),
+                                       value=(date_min.to_pydatetime().replace(tzinfo=None),
+                                              date_max.to_pydatetime().replace(tzinfo=None)),
+                                       step=timedelta(minutes=5), format="YYYY-MM-DD HH:mm")
+        zoom_min, zoom_max = pd.Timestamp(zoom_min), pd.Timestamp(zoom_max)
+        if date_min.tz is not None:
+            zoom_min, zoom_max = (zoom.tz_localize(date_min.tz, ambiguous=True, nonexistent="shift_forward")
+                                  for zoom in (zoom_min, zoom_max))
+        if zoom_min > date_min or zoom_max < date_max:
+            df_graph = df[df["date"].between(zoom_min, zoom_max)]
+
+    # Show graph with the selected columns
+    show_graph(df_graph, col_name1, col_name2, col_name3, perf=perf)
+
+
+def show_performance(perf):
+    from nsdata import TRANSPORT
+
+    summary = pd.DataFrame.from_dict(perf.summary(), orient="index")
+    st.dataframe(summary.sort_values("duration_s", ascending=False) if len(summary) else summary)
+    st.dataframe(pd.DataFrame(perf.events()))
+    st.write("Fetch scheduler, all sessions:")
+    st.dataframe(pd.DataFrame.from_dict(TRANSPORT.stats(), orient="index"))
+    col1, col2 = st.columns(2)
+    col1.download_button("Download JSON log", "\n".join(perf.to_log_lines()), file_name="nsview_perf.jsonl")
+    col2.download_button("Download Prometheus metrics", perf.to_prometheus(), file_name="nsview_perf.prom")
 
 
 def main():
-    ns_url_cookie = cookie_manager.get(cookie=COOKIE_NS_URL)
+    st.set_page_config(layout="wide", page_title=title)
+    cookies, cookie_manager = get_cookies()
+    perf = PerfRecorder()
+
+    ns_url_cookie = cookies.get(COOKIE_NS_URL)
     ns_url_cookie = ns_url_cookie if ns_url_cookie else ""
-    ns_token_cookie = cookie_manager.get(cookie=COOKIE_NS_TOKEN)
+    ns_token_cookie = cookies.get(COOKIE_NS_TOKEN)
     ns_token_cookie = ns_token_cookie if ns_token_cookie else ""
-    timezone_cookie = cookie_manager.get(cookie=COOKIE_TIMEZONE)
+    timezone_cookie = cookies.get(COOKIE_TIMEZONE)
     timezone_cookie = timezone_cookie if timezone_cookie else TZ_DONT_CONVERT
 
     with st.sidebar:
@@ -191,12 +618,16 @@ def main():
 
             min_date, max_date = st.date_input("Date Range:", value=[min_date, max_date])
 
-            tzs = [TZ_DONT_CONVERT] + [str(tz) for tz in pytz.common_timezones]
+            tzs = timezone_options()
             try:
                 tz_cookie_index = tzs.index(timezone_cookie)
             except ValueError:
                 tz_cookie_index = 0
             timezone_name = st.selectbox("Convert to Timezone:", options=tzs, index=tz_cookie_index)
+            join_streams = st.checkbox("Join entries and treatments", value=True,
+                                       help="Add nearest sgv and 3h carbs/insulin to each loop decision")
+            resolution_name = st.selectbox("Resolution:", [RESOLUTION_AUTO, RESOLUTION_RAW] + list(nsrollup.RESOLUTIONS),
+                                           help="Auto shows long ranges as min/mean/max per time bucket")
 
             if timezone_name != TZ_DONT_CONVERT:
                 tz = pytz.timezone(timezone_name)
@@ -206,6 +637,8 @@ def main():
             min_date = tz.localize(datetime(min_date.year, min_date.month, min_date.day))
 
             submit_button = st.form_submit_button("Submit")
+        live_mode = st.checkbox("Live", help="Keep polling Nightscout for new data")
+        live_interval = st.selectbox("Refresh every (seconds):", LIVE_INTERVALS, index=2, disabled=not live_mode)
         st.write("\n__Author:__ [Rafael Del Rey](https://www.linkedin.com/in/rafaeldelrey)")
 
     if submit_button or st.session_state.get("button_submit", False):
@@ -222,41 +655,105 @@ def main():
             max_date = max_date.replace(tzinfo=pytz.utc)
             # st.write(max_date)
 
-            if submit_button:
-                # Dont use cache, if clicked on the button
-                df = get_ns_data(ns_url, ns_token, str(min_date), str(max_date), timezone_name)
+            # Raw UTC data of this session, refetched only when clicking on the button with the same
+            # settings (to refresh) or when the site or dates change; other settings only change the view
+            fetch_key = (ns_url, ns_token, str(min_date), str(max_date), join_streams)
+            view_settings = (timezone_name, resolution_name)
+            refresh = submit_button and st.session_state.get("view_settings") == view_settings
+            st.session_state["view_settings"] = view_settings
+
+            # Ranges too long to plot raw are shown as rollups, read from the cache when already built.
+            # Ranges reaching now and live mode need fresh rows, so are built from raw data.
+            start_ms, end_ms = nscache.to_ms(min_date), nscache.to_ms(max_date)
+            if resolution_name == RESOLUTION_AUTO:
+                resolution = nsrollup.choose_resolution(start_ms, end_ms, GRAPH_WIDTH_PX)
+            elif resolution_name == RESOLUTION_RAW:
+                resolution = None
             else:
-                df = get_cached_ns_data(ns_url, ns_token, str(min_date), str(max_date), timezone_name)
-
-        if (df is None) or (len(df) == 0):
+                resolution = resolution_name
+            df_rollup = None
+            if resolution is not None and CACHE_DIR and not refresh and not live_mode:
+                with perf.stage("rollup.read"):
+                    df_rollup = nsrollup.read_rollup(CACHE_DIR, ns_url, resolution, start_ms, end_ms, ns_token)
+
+            if df_rollup is None:
+                raw = st.session_state.get("raw_data")
+                if raw is None or raw[0] != fetch_key or refresh:
+                    df_raw = get_raw_ns_data(ns_url, ns_token, str(min_date), str(max_date), perf=perf)
+                    streams = None
+                    if join_streams and len(df_raw) > 0:
+                        streams = get_raw_streams(ns_url, ns_token, str(min_date), str(max_date), perf=perf)
+                    fingerprint = None
+                    if len(df_raw) > 0:
+                        fingerprint = data_fingerprint(df_raw, *(streams or {}).values())
+                    raw = (fetch_key, fingerprint, df_raw, streams)
+                    st.session_state["raw_data"] = raw
+                    if fingerprint is not None and CACHE_DIR:
+                        df_parsed, _ = get_parsed_ns_data(fingerprint, df_raw, streams, perf=perf)
+                        with perf.stage("rollup.update", records=len(df_raw)):
+                            nsrollup.update_rollups(CACHE_DIR, ns_url, df_parsed, start_ms, end_ms, ns_token)
+
+        if df_rollup is None:
+            _, fingerprint, df_raw, streams = raw
+            if fingerprint is None:
+                st.warning("No data loaded!")
+                return
+            df, store = get_parsed_ns_data(fingerprint, df_raw, streams, perf=perf)
+
+            # New data appended in live mode, kept until the raw data is refetched
+            live_key = (fetch_key, fingerprint)
+            live = st.session_state.get("live_data")
+            if live is None or live[0] != live_key:
+                live = (live_key, df, store)
+            if live_mode:
+                live = (live_key, *tail_ns_data(ns_url, ns_token, live[1], live[2], perf=perf))
+            st.session_state["live_data"] = live
+            df = live[1]
+
+            if resolution is not None:
+                with perf.stage("rollup.build", records=len(df)):
+                    df = nsrollup.rollup_frame(nsrollup.bucket_stats(df, nsrollup.RESOLUTIONS[resolution]))
+        else:
+            df = df_rollup
+
+        if len(df) == 0:
             st.warning("No data loaded!")
             return
+        df = view_ns_data(df, timezone_name, perf=perf)
 
         # Store cookies
-        cookie_manager.set(COOKIE_NS_URL, ns_url, key=COOKIE_NS_URL + "_set")
-        cookie_manager.set(COOKIE_NS_TOKEN, ns_token, key=COOKIE_NS_TOKEN + "_set")
-        cookie_manager.set(COOKIE_TIMEZONE, timezone_name, key=COOKIE_TIMEZONE + "_set")
+        save_cookies(cookies, cookie_manager,
+                     {COOKIE_NS_URL: ns_url, COOKIE_NS_TOKEN: ns_token, COOKIE_TIMEZONE: timezone_name})
 
         st.subheader(title)
+        suffix = ""
+        if resolution is not None:
+            st.caption(f"Showing min/mean/max per {resolution}")
+            suffix = ".mean"
 
-        # Define columns to plot
-        col1, col2, col3 = st.columns(3)
-        cols_graph_first = ["suggested.bg", "reason.ISF", "reason.CR", "CF"]       # Show these first
-        cols_graph_first = [col for col in cols_graph_first if col in df.columns]  # if they exist in the data
-        cols_graph = cols_graph_first + sorted(set(df.columns) - set(cols_graph_first))
-        index1 = get_list_index(cols_graph, "suggested.bg", 0)
-        index2 = get_list_index(cols_graph, "reason.ISF", 1)
-
-        col_name1 = col1.selectbox("Graph Column 1:", cols_graph, index=index1)
-        col_name2 = col2.selectbox("Graph Column 2:", cols_graph, index=index2)
-        col_name3 = col3.selectbox("Graph Column 3:", [""] + cols_graph, index=0)
-
-        # Show graph with the selected columns
-        show_graph(df, col_name1, col_name2, col_name3)
+        # Graph and grid rerun on their own when their widgets change
+        show_graph_section(df, suffix, perf=perf)
 
         # Show data
         st.subheader("Data:")
-        show_data(df)
+        show_data(df, perf=perf)
+
+        with st.expander("Memory usage"):
+            if st.checkbox("Compute memory usage"):
+                report = memory_report(df)
+                st.write(f"Total: {report['bytes'].sum() / 2 ** 20:.1f} MB in {len(df)} rows x {len(df.columns)} columns")
+                st.dataframe(report)
+
+        with st.expander("Performance"):
+            show_performance(perf)
+
+        if live_mode:
+            # Sleep in steps: widget changes rerun the script at the next streamlit call
+            countdown = st.sidebar.empty()
+            for remaining in range(live_interval, 0, -1):
+                countdown.caption(f"Next refresh in {remaining}s")
+                time.sleep(1)
+            st.rerun()
 
 
 if __name__ == "__main__":
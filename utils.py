@@ -1,5 +1,41 @@
+import numpy as np
+
+
 def get_list_index(list_to_check, item_value, default_return):
     try:
         return list_to_check.index(item_value)
     except ValueError:
         return default_return
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Return indices of a Largest-Triangle-Three-Buckets downsample of x, y.
+
+    x must be ascending and neither may contain NaN. The first and last
+    points are always kept, plus one point per bucket in between.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # threshold - 2 buckets over the points between first and last
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a])
+                       - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+    return indices